@@ -1,15 +1,24 @@
+import contextlib
+import cProfile
 import difflib
+import functools
 import json
 import os
+import pathlib
+import queue
 import re
 import shutil
 import sqlite3
 import sys
+import threading
 import time
 import traceback
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     import psutil  # pip install psutil
@@ -37,6 +46,18 @@ except Exception:
 DB_VERSION_FILE_REFACTOR = 32
 DB_VERSION_SCENE_STUDIO_CODE = 38
 
+SQLITE_MAX_VARIABLES = 900
+
+RE_TEMPLATE_FIELD = re.compile(r"\$\w+")
+RE_EMPTY_GROUP = re.compile(r"\(\W*\)|\[\W*\]|{[^a-zA-Z0-9]*}")
+RE_GROUP_BRACES = re.compile(r"[{}]")
+RE_CONSECUTIVE_NONWORD = re.compile(r"(\W+)\1+")
+RE_ILLEGAL_CHARACTER = re.compile('[\\/:"*?<>|]+')
+RE_APOSTROPHE = re.compile("[’‘”“]+")
+RE_CAPITALIZE_WORD = re.compile(r"\b[A-Z]?[a-z\'\u2019\u2018]+\b")
+# template -> tokens, see compile_template
+TEMPLATE_CACHE = {}
+
 DRY_RUN = config.dry_run
 DRY_RUN_FILE = None
 
@@ -52,10 +73,111 @@ if DRY_RUN:
     log.LogInfo("Dry mode on")
 
 START_TIME = time.time()
+PERF_START = time.perf_counter()
 FRAGMENT = json.loads(sys.stdin.read())
 
+# stage -> [calls, seconds], see timed
+PROFILING = config.profiling
+PROFILING_TRACE = config.profiling_trace
+STAGE_TIMERS = {}
+STAGE_LOCK = threading.Lock()
+TRACE_EVENTS = []
+TRACE_MAX_EVENTS = 200000
+PROFILER = None
+if PROFILING and PROFILING_TRACE == "cprofile":
+    PROFILER = cProfile.Profile()
+    PROFILER.enable()
+
+
+def timed(func):
+    # Count the calls/time of the function when profiling is enabled
+    if not PROFILING:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            with STAGE_LOCK:
+                timer = STAGE_TIMERS.setdefault(func.__name__, [0, 0.0])
+                timer[0] += 1
+                timer[1] += duration
+                if PROFILING_TRACE == "json" and len(TRACE_EVENTS) < TRACE_MAX_EVENTS:
+                    TRACE_EVENTS.append(
+                        {
+                            "name": func.__name__,
+                            "ph": "X",
+                            "ts": round((start - PERF_START) * 1e6),
+                            "dur": round(duration * 1e6),
+                            "pid": os.getpid(),
+                            "tid": threading.get_ident(),
+                        }
+                    )
+
+    return wrapper
+
+
+def profiling_report():
+    if not PROFILING:
+        return
+    log.LogInfo(
+        f"[Profiling] {'stage':<24}{'calls':>8}{'total (s)':>12}{'mean (ms)':>12}"
+    )
+    for stage, (calls, seconds) in sorted(
+        STAGE_TIMERS.items(), key=lambda x: x[1][1], reverse=True
+    ):
+        log.LogInfo(
+            f"[Profiling] {stage:<24}{calls:>8}{seconds:>12.3f}{seconds / calls * 1000:>12.3f}"
+        )
+    directory = os.path.dirname(config.log_file) if config.log_file else PLUGIN_DIR
+    try:
+        if PROFILER:
+            PROFILER.disable()
+            trace_file = os.path.join(directory, "renamerOnUpdate.prof")
+            PROFILER.dump_stats(trace_file)
+        elif PROFILING_TRACE == "json":
+            trace_file = os.path.join(directory, "renamerOnUpdate_trace.json")
+            with open(trace_file, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": TRACE_EVENTS}, f)
+        else:
+            return
+        log.LogInfo(f"[Profiling] Trace written in {trace_file}")
+    except Exception as err:
+        log.LogWarning(f"[Profiling] Can't write the trace ({err})")
+
+
 FRAGMENT_SERVER = FRAGMENT["server_connection"]
 PLUGIN_DIR = FRAGMENT_SERVER["PluginDir"]
+# studios looked up, kept LOOKUP_CACHE_TTL hours on the disk (0 = disabled)
+LOOKUP_CACHE_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_cache.json")
+LOOKUP_CACHE_TTL = config.lookup_cache_ttl
+LOOKUP_CACHE = None
+LOOKUP_CACHE_DIRTY = False
+LOOKUP_DISK_HITS = {}
+# hook_queue: the hooks write the scene id in HOOK_QUEUE_FILE, one worker renames them
+PLUGIN_ID = os.path.splitext(os.path.basename(__file__))[0]
+HOOK_QUEUE_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_queue.txt")
+# each worker moves the queue to its own .work file ({} = owner of the file)
+HOOK_QUEUE_WORK = HOOK_QUEUE_FILE + ".{}.work"
+HOOK_QUEUE_LOCK = os.path.join(PLUGIN_DIR, "renamerOnUpdate_queue.lock")
+# held by a hook while it appends and by the worker while it takes the queue
+HOOK_QUEUE_APPEND_LOCK = os.path.join(PLUGIN_DIR, "renamerOnUpdate_queue_append.lock")
+HOOK_QUEUE_TASK = "Process hook queue"
+HOOK_QUEUE_IDLE = config.hook_queue_idle
+HOOK_QUEUE_TIMEOUT = 300
+# database path/schema of the server (server_capabilities)
+CAPABILITY_CACHE_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_server.json")
+CAPABILITY_CACHE_TTL = config.capability_cache_ttl
+CAPABILITY_SERVER = (
+    f"{FRAGMENT_SERVER['Scheme']}://{FRAGMENT_SERVER['Host']}:{FRAGMENT_SERVER['Port']}"
+)
+STARTUP_TIME = None
+# keep-alive connections to Stash (queries/mutations), see graphql_session
+GRAPHQL_SESSIONS = {}
+GRAPHQL_BATCH = config.graphql_batch
 
 
 PLUGIN_ARGS = FRAGMENT["args"].get("mode")
@@ -63,18 +185,49 @@ PLUGIN_ARGS = FRAGMENT["args"].get("mode")
 # log.LogDebug("{}".format(FRAGMENT))
 
 
+def graphql_session(mutation=False):
+    # One session for the run: the connection is kept alive between the calls.
+    # A mutation is only sent again if the connection failed (not received),
+    # a query is also retried after a read error or a 5xx.
+    if mutation not in GRAPHQL_SESSIONS:
+        session = requests.Session()
+        session.headers.update(
+            {
+                "Accept-Encoding": "gzip, deflate, br",
+                "Content-Type": "application/json",
+                "Accept": "application/json",
+                "Connection": "keep-alive",
+                "DNT": "1",
+            }
+        )
+        # Session cookie for authentication
+        session.cookies.update({"session": FRAGMENT_SERVER["SessionCookie"]["Value"]})
+        if mutation:
+            retry = Retry(
+                total=config.graphql_retries,
+                connect=config.graphql_retries,
+                read=0,
+                status=0,
+                backoff_factor=config.graphql_backoff,
+                allowed_methods=None,
+            )
+        else:
+            retry = Retry(
+                total=config.graphql_retries,
+                backoff_factor=config.graphql_backoff,
+                status_forcelist=[502, 503, 504],
+                allowed_methods=None,
+            )
+        session.mount("http://", HTTPAdapter(max_retries=retry))
+        session.mount("https://", HTTPAdapter(max_retries=retry))
+        GRAPHQL_SESSIONS[mutation] = session
+    return GRAPHQL_SESSIONS[mutation]
+
+
+@timed
 def callGraphQL(query, variables=None):
-    # Session cookie for authentication
     graphql_port = str(FRAGMENT_SERVER["Port"])
     graphql_scheme = FRAGMENT_SERVER["Scheme"]
-    graphql_cookies = {"session": FRAGMENT_SERVER["SessionCookie"]["Value"]}
-    graphql_headers = {
-        "Accept-Encoding": "gzip, deflate, br",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Connection": "keep-alive",
-        "DNT": "1",
-    }
     graphql_domain = FRAGMENT_SERVER["Host"]
     if graphql_domain == "0.0.0.0":
         graphql_domain = "localhost"
@@ -85,17 +238,16 @@ def callGraphQL(query, variables=None):
     if variables is not None:
         json["variables"] = variables
     try:
-        response = requests.post(
-            graphql_url,
-            json=json,
-            headers=graphql_headers,
-            cookies=graphql_cookies,
-            timeout=20,
+        response = graphql_session(query.lstrip().startswith("mutation")).post(
+            graphql_url, json=json, timeout=20
         )
     except Exception as e:
         exit_plugin(err=f"[FATAL] Error with the graphql request {e}")
     if response.status_code == 200:
         result = response.json()
+        if result.get("error") or result.get("errors"):
+            # the cached schema version could be outdated (scene fragment)
+            server_capabilities_forget()
         if result.get("error"):
             for error in result["error"]["errors"]:
                 raise Exception(f"GraphQL error: {error}")
@@ -110,14 +262,27 @@ def callGraphQL(query, variables=None):
         )
 
 
-def graphql_getScene(scene_id):
-    query = (
+def graphql_batch(
+    field: str, types: dict, selection: str, variables_list: list, fragment=""
+):
+    # Send the same query for each variables in one request (aliases q0, q1...)
+    definitions = []
+    fields = []
+    variables = {}
+    for n, var in enumerate(variables_list):
+        for name, value in var.items():
+            variables[f"{name}{n}"] = value
+            definitions.append(f"${name}{n}: {types[name]}")
+        arguments = ", ".join(f"{name}: ${name}{n}" for name in var)
+        fields.append(f"q{n}: {field}({arguments}) {selection}")
+    query = f"query Batch({', '.join(definitions)}) {{ {' '.join(fields)} }}{fragment}"
+    result = callGraphQL(query, variables)
+    return [result.get(f"q{n}") for n in range(len(variables_list))]
+
+
+def graphql_sceneFragment():
+    return (
         """
-    query FindScene($id: ID!, $checksum: String) {
-        findScene(id: $id, checksum: $checksum) {
-            ...SceneData
-        }
-    }
     fragment SceneData on Scene {
         id
         title
@@ -127,7 +292,8 @@ def graphql_getScene(scene_id):
             endpoint
             stash_id
         }
-        organized"""
+        organized
+        updated_at"""
         + FILE_QUERY
         + """
         studio {
@@ -163,17 +329,42 @@ def graphql_getScene(scene_id):
     }
     """
     )
+
+
+@timed
+def graphql_getScene(scene_id):
+    query = """
+    query FindScene($id: ID!, $checksum: String) {
+        findScene(id: $id, checksum: $checksum) {
+            ...SceneData
+        }
+    }
+    """ + graphql_sceneFragment()
     variables = {"id": scene_id}
     result = callGraphQL(query, variables)
     return result.get("findScene")
 
 
+@timed
+def graphql_getScenes(scene_ids: list) -> list:
+    # graphql_getScene for several scenes, in one request
+    return graphql_batch(
+        "findScene",
+        {"id": "ID!"},
+        "{ ...SceneData }",
+        [{"id": scene_id} for scene_id in scene_ids],
+        graphql_sceneFragment(),
+    )
+
+
 # used for bulk
-def graphql_findScene(perPage, direc="DESC") -> dict:
+def graphql_findScene(
+    perPage, direc="DESC", page=1, sort="updated_at", scene_filter=None
+) -> dict:
     query = (
         """
-    query FindScenes($filter: FindFilterType) {
-        findScenes(filter: $filter) {
+    query FindScenes($filter: FindFilterType, $scene_filter: SceneFilterType) {
+        findScenes(filter: $filter, scene_filter: $scene_filter) {
             count
             scenes {
                 ...SlimSceneData
@@ -186,6 +377,7 @@ def graphql_findScene(perPage, direc="DESC") -> dict:
         date
         rating100
         organized
+        updated_at
         stash_ids {
             endpoint
             stash_id
@@ -230,15 +422,277 @@ def graphql_findScene(perPage, direc="DESC") -> dict:
     variables = {
         "filter": {
             "direction": direc,
-            "page": 1,
+            "page": page,
             "per_page": perPage,
-            "sort": "updated_at",
+            "sort": sort,
         }
     }
+    if scene_filter:
+        variables["scene_filter"] = scene_filter
     result = callGraphQL(query, variables)
     return result.get("findScenes")
 
 
+def bulk_scene_pages(per_page: int, after_id=0, limit=-1, scene_filter=None):
+    # Walk the library by ascending id, the filter on the id is used as a cursor
+    # so only one page is in memory and a run can restart after any scene.
+    total = None
+    processed = 0
+    while True:
+        page_filter = {"id": {"value": int(after_id), "modifier": "GREATER_THAN"}}
+        if scene_filter:
+            page_filter.update(scene_filter)
+        result = graphql_findScene(per_page, "ASC", 1, "id", page_filter)
+        if total is None:
+            total = result["count"]
+            if limit > 0:
+                total = min(total, limit)
+            log.LogDebug(f"Count scenes: {total}")
+        scenes = result["scenes"]
+        if limit > 0:
+            scenes = scenes[: limit - processed]
+        if not scenes:
+            return
+        yield total, scenes
+        processed += len(scenes)
+        after_id = scenes[-1]["id"]
+        if len(result["scenes"]) < per_page or (limit > 0 and processed >= limit):
+            return
+
+
+def prefetch_pages(pages, depth: int):
+    # Iterate over the pages while the next ones are fetched by a thread,
+    # at most depth pages wait in memory.
+    if depth < 1:
+        yield from pages
+        return
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def producer():
+        try:
+            for page in pages:
+                while not stop.is_set():
+                    try:
+                        buffer.put((page, None), timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            buffer.put((done, None))
+        except BaseException as err:
+            buffer.put((done, err))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            page, err = buffer.get()
+            if err is not None:
+                raise err
+            if page is done:
+                return
+            yield page
+    finally:
+        stop.set()
+
+
+def bulk_state_read():
+    try:
+        with open(BULK_STATE_FILE, "r", encoding="utf-8") as f:
+            return int(json.load(f)["last_id"])
+    except FileNotFoundError:
+        return 0
+    except Exception as err:
+        log.LogWarning(
+            f"Can't read the bulk state file, starting from the beginning ({err})"
+        )
+        return 0
+
+
+def bulk_state_write(last_id):
+    if DRY_RUN:
+        return
+    try:
+        with open(BULK_STATE_FILE, "w", encoding="utf-8") as f:
+            json.dump({"last_id": int(last_id)}, f)
+    except Exception as err:
+        log.LogWarning(f"Can't save the bulk state ({err})")
+
+
+def bulk_state_clear():
+    if os.path.exists(BULK_STATE_FILE):
+        os.remove(BULK_STATE_FILE)
+
+
+def graphql_runPluginTask(task_name: str):
+    query = """
+    mutation RunPluginTask($plugin_id: ID!, $task_name: String) {
+        runPluginTask(plugin_id: $plugin_id, task_name: $task_name)
+    }
+    """
+    variables = {"plugin_id": PLUGIN_ID, "task_name": task_name}
+    return callGraphQL(query, variables)
+
+
+def hook_worker_alive() -> bool:
+    # the worker touches the lock file while it runs
+    try:
+        if os.path.getmtime(HOOK_QUEUE_LOCK) > time.time() - HOOK_QUEUE_TIMEOUT:
+            return True
+        log.LogWarning("The hook worker doesn't respond, starting a new one")
+        os.remove(HOOK_QUEUE_LOCK)
+    except OSError:
+        pass
+    return False
+
+
+def hook_worker_claim() -> bool:
+    # only one process can create the lock file
+    try:
+        fd = os.open(HOOK_QUEUE_LOCK, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+    return True
+
+
+def hook_worker_release():
+    try:
+        os.remove(HOOK_QUEUE_LOCK)
+    except FileNotFoundError:
+        pass
+
+
+def hook_worker_heartbeat() -> threading.Event:
+    # Touch the lock file from a thread until the event is set, a long batch
+    # (flush_pending_rename) must not make the worker look stale.
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(HOOK_QUEUE_TIMEOUT / 10):
+            try:
+                os.utime(HOOK_QUEUE_LOCK)
+            except FileNotFoundError:
+                pass
+
+    threading.Thread(target=beat, daemon=True).start()
+    return stop
+
+
+@contextlib.contextmanager
+def hook_queue_lock():
+    # Short lock, so an id is never appended to the queue after the worker took it.
+    # A lock older than a few seconds was left by a killed process.
+    while True:
+        try:
+            fd = os.open(HOOK_QUEUE_APPEND_LOCK, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if os.path.getmtime(HOOK_QUEUE_APPEND_LOCK) < time.time() - 10:
+                    os.remove(HOOK_QUEUE_APPEND_LOCK)
+                    continue
+            except OSError:
+                continue
+            time.sleep(0.05)
+    os.close(fd)
+    try:
+        yield
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(HOOK_QUEUE_APPEND_LOCK)
+
+
+def hook_enqueue(scene_id):
+    # The hook only adds the scene to the queue, then starts the worker
+    # (the task 'Process hook queue') if it's not running.
+    with hook_queue_lock(), open(HOOK_QUEUE_FILE, "a", encoding="utf-8") as f:
+        f.write(f"{scene_id}\n")
+    if hook_worker_alive() or not hook_worker_claim():
+        return
+    try:
+        graphql_runPluginTask(HOOK_QUEUE_TASK)
+    except Exception as err:
+        hook_worker_release()
+        log.LogError(f"Can't start the hook worker ({err})")
+
+
+def hook_queue_take(work_file: str) -> list:
+    # Take the whole queue, the scenes stay in the .work file until they are done.
+    # The .work file of a dead worker is taken over, never the one of a live worker.
+    if not os.path.exists(work_file):
+        prefix, suffix = os.path.basename(HOOK_QUEUE_WORK).split("{}")
+        for name in os.listdir(PLUGIN_DIR):
+            if not name.startswith(prefix) or not name.endswith(suffix):
+                continue
+            owner = name[len(prefix) : -len(suffix)].replace("_", ":")
+            # can't be checked (None): the worker holding the lock is the only live one
+            if process_alive(owner):
+                continue
+            try:
+                os.replace(os.path.join(PLUGIN_DIR, name), work_file)
+                log.LogWarning(f"Taking over the queue of a dead worker ({owner})")
+                break
+            except OSError:
+                continue
+        else:
+            try:
+                with hook_queue_lock():
+                    os.replace(HOOK_QUEUE_FILE, work_file)
+            except (FileNotFoundError, PermissionError):
+                return []
+    with open(work_file, "r", encoding="utf-8") as f:
+        return list(dict.fromkeys(int(x) for x in f.read().split()))
+
+
+def hook_queue_drain():
+    # Rename the queued scenes until the queue stays empty HOOK_QUEUE_IDLE seconds
+    stash_db = connect_db(STASH_DATABASE)
+    if stash_db is None:
+        hook_worker_release()
+        return
+    work_file = HOOK_QUEUE_WORK.format(JOURNAL_OWNER.replace(":", "_"))
+    heartbeat = hook_worker_heartbeat()
+    last_work = time.time()
+    try:
+        while True:
+            scene_ids = hook_queue_take(work_file)
+            if scene_ids:
+                log.LogInfo(f"{len(scene_ids)} scene(s) in the hook queue")
+                PATH_INDEX.clear()
+                BASENAME_INDEX.clear()
+                FOLDER_INDEX.clear()
+                path_index_load(stash_db)
+                for n in range(0, len(scene_ids), BULK_PER_PAGE):
+                    for scene in graphql_getScenes(scene_ids[n : n + BULK_PER_PAGE]):
+                        if not scene:
+                            continue
+                        try:
+                            renamer(scene, stash_db)
+                        except Exception as err:
+                            log.LogError(f"main function error: {err}")
+                flush_pending_rename(stash_db)
+                os.remove(work_file)
+                last_work = time.time()
+                continue
+            if time.time() - last_work > HOOK_QUEUE_IDLE:
+                heartbeat.set()
+                hook_worker_release()
+                # a hook could have queued a scene just before the lock was removed
+                if not os.path.exists(HOOK_QUEUE_FILE) or not hook_worker_claim():
+                    break
+                heartbeat = hook_worker_heartbeat()
+                continue
+            time.sleep(1)
+    finally:
+        heartbeat.set()
+    stash_db.close()
+
+
 # used to find duplicate
 def graphql_findScenebyPath(path, modifier) -> dict:
     query = """
@@ -261,6 +715,29 @@ def graphql_findScenebyPath(path, modifier) -> dict:
     return result.get("findScenes")
 
 
+def graphql_findScenesbyPath(paths: list, modifier) -> list:
+    # graphql_findScenebyPath for several paths, in one request
+    if not GRAPHQL_BATCH:
+        return [graphql_findScenebyPath(path, modifier) for path in paths]
+    return graphql_batch(
+        "findScenes",
+        {"filter": "FindFilterType", "scene_filter": "SceneFilterType"},
+        "{ count scenes { id title } }",
+        [
+            {
+                "filter": {
+                    "direction": "ASC",
+                    "page": 1,
+                    "per_page": 40,
+                    "sort": "updated_at",
+                },
+                "scene_filter": {"path": {"modifier": modifier, "value": path}},
+            }
+            for path in paths
+        ],
+    )
+
+
 def graphql_getConfiguration():
     query = """
         query Configuration {
@@ -275,7 +752,64 @@ def graphql_getConfiguration():
     return result.get("configuration")
 
 
+def lookup_cache_load():
+    global LOOKUP_CACHE
+    LOOKUP_CACHE = {}
+    if not LOOKUP_CACHE_TTL or not os.path.isfile(LOOKUP_CACHE_FILE):
+        return
+    try:
+        with open(LOOKUP_CACHE_FILE, "r", encoding="utf-8") as f:
+            LOOKUP_CACHE = json.load(f)
+    except Exception as err:
+        log.LogWarning(f"Can't read the cache file ({err})")
+    # drop the expired values
+    expire = time.time() - LOOKUP_CACHE_TTL * 3600
+    for kind in LOOKUP_CACHE.values():
+        for key in [k for k, v in kind.items() if v["time"] < expire]:
+            del kind[key]
+
+
+def lookup_cache_save():
+    if not LOOKUP_CACHE_TTL or not LOOKUP_CACHE_DIRTY:
+        return
+    try:
+        with open(LOOKUP_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(LOOKUP_CACHE, f)
+    except Exception as err:
+        log.LogWarning(f"Can't save the cache file ({err})")
+
+
+def lookup_cached(kind: str, key, fetch):
+    # value from the on-disk cache, else fetch(key) (and keep it)
+    global LOOKUP_CACHE_DIRTY
+    if LOOKUP_CACHE is None:
+        lookup_cache_load()
+    values = LOOKUP_CACHE.setdefault(kind, {})
+    if str(key) in values:
+        LOOKUP_DISK_HITS[kind] = LOOKUP_DISK_HITS.get(kind, 0) + 1
+        return values[str(key)]["value"]
+    value = fetch(key)
+    if LOOKUP_CACHE_TTL and value is not None:
+        values[str(key)] = {"value": value, "time": time.time()}
+        LOOKUP_CACHE_DIRTY = True
+    return value
+
+
+def lookup_cache_stats():
+    info = graphql_getStudio.cache_info()
+    if info.hits or info.misses:
+        log.LogDebug(
+            f"[Cache] studio: {info.hits} hit(s), {info.misses} miss(es), {LOOKUP_DISK_HITS.get('studio', 0)} from the disk"
+        )
+
+
+# the same studios come back for every scene
+@functools.lru_cache(maxsize=1024)
 def graphql_getStudio(studio_id):
+    return lookup_cached("studio", studio_id, graphql_findStudio)
+
+
+def graphql_findStudio(studio_id):
     query = """
         query FindStudio($id:ID!) {
             findStudio(id: $id) {
@@ -320,6 +854,91 @@ def graphql_getBuild():
     return result["systemStatus"]["databaseSchema"]
 
 
+def graphql_getCapabilities():
+    # getConfiguration + getBuild in one request
+    query = """
+        {
+            configuration {
+                general {
+                    databasePath
+                }
+            }
+            systemStatus {
+                databaseSchema
+            }
+        }
+    """
+    result = callGraphQL(query)
+    return {
+        "database_path": result["configuration"]["general"]["databasePath"],
+        "db_version": result["systemStatus"]["databaseSchema"],
+    }
+
+
+def capability_cache_read() -> dict:
+    try:
+        with open(CAPABILITY_CACHE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as err:
+        log.LogWarning(f"Can't read the server cache file ({err})")
+    return {}
+
+
+def capability_cache_write(cache: dict):
+    try:
+        with open(CAPABILITY_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    except Exception as err:
+        log.LogWarning(f"Can't save the server cache file ({err})")
+
+
+def db_schema_version(database_path: str):
+    # schema version written by Stash's migrations, read without asking Stash
+    try:
+        db = sqlite3.connect(
+            pathlib.Path(database_path).as_uri() + "?mode=ro", uri=True
+        )
+        try:
+            return db.execute("SELECT version FROM schema_migrations").fetchone()[0]
+        finally:
+            db.close()
+    except Exception:
+        return None
+
+
+def server_capabilities():
+    # The database path/schema only change with a restart of Stash, they are
+    # kept CAPABILITY_CACHE_TTL seconds so the hooks don't ask each time.
+    # An upgrade (migration) changes the schema version in the database, the
+    # cached values are only used while it's the same.
+    cache = {}
+    if CAPABILITY_CACHE_TTL:
+        cache = capability_cache_read()
+        cached = cache.get(CAPABILITY_SERVER)
+        if (
+            cached
+            and cached["time"] > time.time() - CAPABILITY_CACHE_TTL
+            and db_schema_version(cached["database_path"]) == cached["db_version"]
+        ):
+            return cached
+    capabilities = graphql_getCapabilities()
+    if CAPABILITY_CACHE_TTL:
+        capabilities["time"] = time.time()
+        cache[CAPABILITY_SERVER] = capabilities
+        capability_cache_write(cache)
+    return capabilities
+
+
+def server_capabilities_forget():
+    # a request failed, the next run asks Stash again
+    if CAPABILITY_CACHE_TTL:
+        cache = capability_cache_read()
+        if cache.pop(CAPABILITY_SERVER, None):
+            capability_cache_write(cache)
+
+
 def find_diff_text(a: str, b: str):
     addi = minus = stay = ""
     minus_ = addi_ = 0
@@ -345,18 +964,91 @@ def find_diff_text(a: str, b: str):
     return
 
 
-def has_handle(fpath, all_result=False):
-    lst = []
+def process_owner(pid=None) -> str:
+    # pid and start time, a pid alone can be reused by another process
+    pid = pid or os.getpid()
+    started = ""
+    if MODULE_PSUTIL:
+        try:
+            started = str(psutil.Process(pid).create_time())
+        except Exception:
+            pass
+    return f"{pid}:{started}"
+
+
+def process_alive(owner):
+    # True/False, or None when it can't be checked (Windows without psutil)
+    pid, _, started = (owner or "").partition(":")
+    try:
+        pid = int(pid)
+    except ValueError:
+        return False
+    if MODULE_PSUTIL:
+        try:
+            proc = psutil.Process(pid)
+            return not started or str(proc.create_time()) == started
+        except psutil.NoSuchProcess:
+            return False
+        except Exception:
+            return True
+    if os.name == "nt":
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def open_files_snapshot() -> dict:
+    # path -> pids of the processes that have it open
+    snapshot = {}
     for proc in psutil.process_iter():
         try:
             for item in proc.open_files():
-                if fpath == item.path:
-                    if all_result:
-                        lst.append(proc)
-                    else:
-                        return proc
+                snapshot.setdefault(item.path, []).append(proc.pid)
         except Exception:
             pass
+    return snapshot
+
+
+def has_handle(fpath, all_result=False):
+    # The first file of a batch is searched process by process (like a single
+    # rename, it stops at the first match). From the second one, the open files
+    # of all the processes are listed once per batch, the list is refreshed when
+    # the file is not in it (opened after the snapshot).
+    with OPEN_FILES_LOCK:
+        if not OPEN_FILES:
+            lst = []
+            for proc in psutil.process_iter():
+                try:
+                    if any(fpath == item.path for item in proc.open_files()):
+                        if not all_result:
+                            OPEN_FILES[fpath] = [proc.pid]
+                            return proc
+                        lst.append(proc)
+                except Exception:
+                    pass
+            OPEN_FILES[fpath] = [proc.pid for proc in lst]
+            return lst
+        if fpath not in OPEN_FILES:
+            OPEN_FILES.clear()
+            OPEN_FILES.update(open_files_snapshot())
+        pids = OPEN_FILES.get(fpath, [])
+    lst = []
+    for pid in pids:
+        # the process could have closed the file since the snapshot
+        try:
+            proc = psutil.Process(pid)
+            if not any(fpath == item.path for item in proc.open_files()):
+                continue
+        except Exception:
+            continue
+        if not all_result:
+            return proc
+        lst.append(proc)
     return lst
 
 
@@ -480,6 +1172,7 @@ def sort_rating(d: dict):
     return new_d
 
 
+@timed
 def extract_info(scene: dict, template: None):
     # Grabbing things from Stash
     scene_information = {}
@@ -746,96 +1439,129 @@ def extract_info(scene: dict, template: None):
 
 
 def replace_text(text: str):
-    for old, new in FILENAME_REPLACEWORDS.items():
+    for pattern, new, system in REPLACE_WORDS:
+        if system == "any":
+            tmp = text.replace(pattern, new)
+        else:
+            tmp = pattern.sub(new, text)
+        if tmp != text:
+            if system == "regex":
+                log.LogDebug(f"Regex matched: {text} -> {tmp}")
+            else:
+                log.LogDebug(
+                    f"'{pattern if system == 'any' else pattern.pattern}' changed"
+                )
+        text = tmp
+    return text
+
+
+def compile_replace_words(replace_words: dict) -> list:
+    # [(pattern, replacement, system)], the regex are compiled once
+    compiled = []
+    for old, new in replace_words.items():
         if type(new) is str:
             new = [new]
-        if len(new) > 1:
-            if new[1] == "regex":
-                tmp = re.sub(old, new[0], text)
-                if tmp != text:
-                    log.LogDebug(f"Regex matched: {text} -> {tmp}")
-            else:
-                if new[1] == "word":
-                    tmp = re.sub(rf"([\s_-])({old})([\s_-])", f"\\1{new[0]}\\3", text)
-                elif new[1] == "any":
-                    tmp = text.replace(old, new[0])
-                if tmp != text:
-                    log.LogDebug(f"'{old}' changed with '{new[0]}'")
+        system = new[1] if len(new) > 1 else "word"
+        if system == "regex":
+            compiled.append((re.compile(old), new[0], system))
+        elif system == "any":
+            compiled.append((old, new[0], system))
         else:
-            tmp = re.sub(rf"([\s_-])({old})([\s_-])", f"\\1{new[0]}\\3", text)
-            if tmp != text:
-                log.LogDebug(f"'{old}' changed with '{new[0]}'")
-        text = tmp
-    return tmp
+            compiled.append(
+                (re.compile(rf"([\s_-])({old})([\s_-])"), f"\\1{new[0]}\\3", system)
+            )
+    return compiled
 
 
 def cleanup_text(text: str):
-    text = re.sub(r"\(\W*\)|\[\W*\]|{[^a-zA-Z0-9]*}", "", text)
-    text = re.sub(r"[{}]", "", text)
+    text = RE_EMPTY_GROUP.sub("", text)
+    text = RE_GROUP_BRACES.sub("", text)
     text = remove_consecutive_nonword(text)
     return text.strip(" -_.")
 
 
 def remove_consecutive_nonword(text: str):
     for _ in range(0, 10):
-        m = re.findall(r"(\W+)\1+", text)
-        if m:
-            text = re.sub(r"(\W+)\1+", r"\1", text)
-        else:
+        text, n = RE_CONSECUTIVE_NONWORD.subn(r"\1", text)
+        if not n:
             break
     return text
 
 
-def field_replacer(text: str, scene_information: dict):
-    field_found = re.findall(r"\$\w+", text)
-    result = text
+def compile_template(template: str, path=False) -> list:
+    # Parse a template once into tokens: (text, field, suffix, before_title)
+    # field is None for literal text. '$year_' is the field 'year' with the suffix '_',
+    # the suffix is removed with the field when there is no value.
+    tokens = TEMPLATE_CACHE.get((template, path))
+    if tokens is not None:
+        return tokens
+    text = str(template)
+    if path:
+        text = text.replace("$performer", "$performer_path")
+    tokens = []
+    position = 0
+    for match in RE_TEMPLATE_FIELD.finditer(text):
+        if match.start() > position:
+            tokens.append((text[position : match.start()], None, "", False))
+        field = match.group(0)[1:].strip("_")
+        suffix = match.group(0)[1:].split(field, 1)[1] if field else ""
+        tokens.append((match.group(0), field, suffix, False))
+        position = match.end()
+    if position < len(text):
+        tokens.append((text[position:], None, "", False))
+    # If $performer is before $title, prevent having duplicate text.
+    # (the fields are compared from the longest to the shortest)
+    fields = sorted([t[0] for t in tokens if t[1] is not None], key=len, reverse=True)
+    for i in range(0, len(fields) - 1):
+        if fields[i][1:].strip("_") == "performer":
+            if fields[i + 1] == "$title":
+                tokens = [t[:3] + (t[1] == "performer",) for t in tokens]
+            break
+    TEMPLATE_CACHE[(template, path)] = tokens
+    return tokens
+
+
+def field_replacer(text: str, scene_information: dict, path=False):
+    # Render the template in one pass, $title is kept and returned separately.
+    result = []
     title = None
-    replaced_word = ""
-    if field_found:
-        field_found.sort(key=len, reverse=True)
-    for i in range(0, len(field_found)):
-        f = field_found[i].replace("$", "").strip("_")
-        # If $performer is before $title, prevent having duplicate text.
-        if (
-            f == "performer"
-            and len(field_found) > i + 1
-            and scene_information.get("performer")
-        ):
-            if (
-                field_found[i + 1] == "$title"
-                and scene_information.get("title")
-                and PREVENT_TITLE_PERF
-            ):
-                if re.search(
-                    f"^{scene_information['performer'].lower()}",
-                    scene_information["title"].lower(),
-                ):
-                    log.LogDebug(
-                        "Ignoring the performer field because it's already in start of title"
-                    )
-                    result = result.replace("$performer", "")
-                    continue
+    for raw, f, suffix, before_title in compile_template(text, path):
+        if f is None:
+            result.append(raw)
+            continue
         replaced_word = scene_information.get(f)
         if not replaced_word:
             replaced_word = ""
+        elif type(replaced_word) is not str:
+            replaced_word = str(replaced_word)
+        if (
+            f == "performer"
+            and before_title
+            and replaced_word
+            and PREVENT_TITLE_PERF
+            and scene_information.get("title")
+            and scene_information["title"].lower().startswith(replaced_word.lower())
+        ):
+            log.LogDebug(
+                "Ignoring the performer field because it's already in start of title"
+            )
+            result.append(suffix)
+            continue
         if FIELD_REPLACER.get(f"${f}"):
             replaced_word = replaced_word.replace(
                 FIELD_REPLACER[f"${f}"]["replace"], FIELD_REPLACER[f"${f}"]["with"]
             )
         if f == "title":
             title = replaced_word.strip()
-            continue
-        if replaced_word == "":
-            result = result.replace(field_found[i], replaced_word)
-        else:
-            result = result.replace(f"${f}", replaced_word)
-    return result, title
+            result.append(f"$title{suffix}")
+        elif replaced_word:
+            result.append(replaced_word + suffix)
+    return "".join(result), title
 
 
 def makeFilename(scene_information: dict, query: str) -> str:
-    new_filename = str(query)
-    r, t = field_replacer(new_filename, scene_information)
-    if FILENAME_REPLACEWORDS:
+    r, t = field_replacer(query, scene_information)
+    if REPLACE_WORDS:
         r = replace_text(r)
     if not t:
         r = r.replace("$title", "")
@@ -848,9 +1574,7 @@ def makeFilename(scene_information: dict, query: str) -> str:
 
 
 def makePath(scene_information: dict, query: str) -> str:
-    new_filename = str(query)
-    new_filename = new_filename.replace("$performer", "$performer_path")
-    r, t = field_replacer(new_filename, scene_information)
+    r, t = field_replacer(query, scene_information, path=True)
     if not t:
         r = r.replace("$title", "")
     r = cleanup_text(r)
@@ -924,9 +1648,10 @@ def capitalizeWords(s: str) -> str:
             return word.lower()
 
     # Apply the regex pattern and the process_word function.
-    return re.sub(r"\b[A-Z]?[a-z\'\u2019\u2018]+\b", process_word, s)
+    return RE_CAPITALIZE_WORD.sub(process_word, s)
 
 
+@timed
 def create_new_filename(scene_info: dict, template: str):
     new_filename = (
         makeFilename(scene_info, template)
@@ -938,17 +1663,17 @@ def create_new_filename(scene_info: dict, template: str):
     if FILENAME_TITLECASE:
         new_filename = capitalizeWords(new_filename)
     # Remove illegal character for Windows
-    new_filename = re.sub('[\\/:"*?<>|]+', "", new_filename)
+    new_filename = RE_ILLEGAL_CHARACTER.sub("", new_filename)
 
-    if FILENAME_REMOVECHARACTER:
-        new_filename = re.sub(f"[{FILENAME_REMOVECHARACTER}]+", "", new_filename)
+    if RE_REMOVECHARACTER:
+        new_filename = RE_REMOVECHARACTER.sub("", new_filename)
 
     # Trying to remove non standard character
     if MODULE_UNIDECODE and UNICODE_USE:
         new_filename = unidecode.unidecode(new_filename, errors="preserve")
     else:
         # Using typewriter for Apostrophe
-        new_filename = re.sub("[’‘”“]+", "'", new_filename)
+        new_filename = RE_APOSTROPHE.sub("'", new_filename)
     return new_filename
 
 
@@ -961,6 +1686,7 @@ def remove_consecutive(liste: list):
     return new_list
 
 
+@timed
 def create_new_path(scene_info: dict, template: dict):
     # Create the new path
     # Split the template path
@@ -973,10 +1699,10 @@ def create_new_path(scene_info: dict, template: dict):
             if not scene_info.get("studio_hierarchy"):
                 continue
             for p in scene_info["studio_hierarchy"]:
-                path_list.append(re.sub('[\\/:"*?<>|]+', "", p).strip())
+                path_list.append(RE_ILLEGAL_CHARACTER.sub("", p).strip())
         else:
             path_list.append(
-                re.sub('[\\/:"*?<>|]+', "", makePath(scene_info, part)).strip()
+                RE_ILLEGAL_CHARACTER.sub("", makePath(scene_info, part)).strip()
             )
     # Remove blank, empty string
     path_split = [x for x in path_list if x]
@@ -994,11 +1720,11 @@ def create_new_path(scene_info: dict, template: dict):
 
     path_edited = os.sep.join(path_split)
 
-    if FILENAME_REMOVECHARACTER:
-        path_edited = re.sub(f"[{FILENAME_REMOVECHARACTER}]+", "", path_edited)
+    if RE_REMOVECHARACTER:
+        path_edited = RE_REMOVECHARACTER.sub("", path_edited)
 
     # Using typewriter for Apostrophe
-    new_path = re.sub("[’‘”“]+", "'", path_edited)
+    new_path = RE_APOSTROPHE.sub("'", path_edited)
 
     return new_path
 
@@ -1013,20 +1739,76 @@ def connect_db(path: str):
     return sqliteConnection
 
 
+@timed
+def path_index_load(stash_db: sqlite3.Connection):
+    # Index every path/basename of the database to check duplicates locally (bulk)
+    global PATH_INDEX_LOADED
+    cursor = stash_db.cursor()
+    if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+        cursor.execute(
+            "SELECT d.path, f.basename, sf.scene_id FROM files AS f JOIN folders AS d ON d.id = f.parent_folder_id LEFT JOIN scenes_files AS sf ON sf.file_id = f.id"
+        )
+        for directory, basename, scene_id in cursor:
+            path_index_add(os.path.join(directory, basename), scene_id)
+    else:
+        cursor.execute("SELECT path, id FROM scenes")
+        for path, scene_id in cursor:
+            path_index_add(path, scene_id)
+    cursor.close()
+    PATH_INDEX_LOADED = True
+    log.LogDebug(f"[DUPLICATE] {len(PATH_INDEX)} paths indexed")
+
+
+def path_index_add(path: str, scene_id):
+    scene_id = str(scene_id) if scene_id is not None else None
+    PATH_INDEX.setdefault(path, []).append(scene_id)
+    BASENAME_INDEX.setdefault(os.path.basename(path), []).append(scene_id)
+
+
+def path_index_remove(path: str, scene_id):
+    scene_id = str(scene_id) if scene_id is not None else None
+    for index, key in [(PATH_INDEX, path), (BASENAME_INDEX, os.path.basename(path))]:
+        if scene_id in index.get(key, []):
+            index[key].remove(scene_id)
+            if not index[key]:
+                del index[key]
+
+
+def path_index_move(scene_id, old_path: str, new_path: str):
+    # keep the index up to date with the renames of this run
+    if PATH_INDEX_LOADED:
+        path_index_remove(old_path, scene_id)
+        path_index_add(new_path, scene_id)
+
+
+@timed
 def checking_duplicate_db(scene_info: dict):
-    scenes = graphql_findScenebyPath(scene_info["final_path"], "EQUALS")
+    if PATH_INDEX_LOADED:
+        if PATH_INDEX.get(scene_info["final_path"]):
+            log.LogError("Duplicate path detected")
+            for dupl_id in PATH_INDEX[scene_info["final_path"]]:
+                log.LogWarning(f"Identical path: [{dupl_id}]")
+            return 1
+        for dupl_id in BASENAME_INDEX.get(scene_info["new_filename"], []):
+            if dupl_id != str(scene_info["scene_id"]):
+                log.LogWarning(f"Duplicate filename: [{dupl_id}]")
+        return
+    scenes, scenes_filename = graphql_findScenesbyPath(
+        [scene_info["final_path"], scene_info["new_filename"]], "EQUALS"
+    )
     if scenes["count"] > 0:
         log.LogError("Duplicate path detected")
         for dupl_row in scenes["scenes"]:
             log.LogWarning(f"Identical path: [{dupl_row['id']}]")
         return 1
-    scenes = graphql_findScenebyPath(scene_info["new_filename"], "EQUALS")
+    scenes = scenes_filename
     if scenes["count"] > 0:
         for dupl_row in scenes["scenes"]:
             if dupl_row["id"] != scene_info["scene_id"]:
                 log.LogWarning(f"Duplicate filename: [{dupl_row['id']}]")
 
 
+@timed
 def db_rename(stash_db: sqlite3.Connection, scene_info):
     cursor = stash_db.cursor()
     # Database rename
@@ -1039,15 +1821,82 @@ def db_rename(stash_db: sqlite3.Connection, scene_info):
     cursor.close()
 
 
+def folder_index_load(cursor: sqlite3.Cursor):
+    # Load the folders table once, missing folders are then resolved in memory
+    global FOLDER_NEXT_ID
+    if not FOLDER_INDEX:
+        cursor.execute("SELECT id, path, parent_folder_id FROM folders")
+        for folder_id, path, parent_id in cursor.fetchall():
+            FOLDER_INDEX[path] = (folder_id, parent_id)
+        log.LogDebug(f"[SQLITE] {len(FOLDER_INDEX)} folders indexed")
+    # Stash can create folders while we are running (scan)
+    cursor.execute("SELECT MAX(id) from folders")
+    FOLDER_NEXT_ID = max(FOLDER_NEXT_ID, (cursor.fetchall()[0][0] or 0) + 1)
+
+
+def folder_index_get(cursor: sqlite3.Cursor, path: str):
+    # (id, parent_folder_id) of the folder, a folder created by Stash since the
+    # index was loaded is read from the database.
+    if path not in FOLDER_INDEX:
+        cursor.execute("SELECT id, parent_folder_id FROM folders WHERE path=?", [path])
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        FOLDER_INDEX[path] = tuple(row)
+    return FOLDER_INDEX[path]
+
+
+def folder_index_resolve(
+    cursor: sqlite3.Cursor, path: str, mod_time: str, new_folders: list
+):
+    # Return the id of the folder, creating the missing folders between the nearest
+    # known parent and the path. The rows to insert are added to new_folders.
+    global FOLDER_NEXT_ID
+    missing = []
+    dir = path
+    while folder_index_get(cursor, dir) is None:
+        parent = os.path.dirname(dir)
+        if parent == dir:
+            # no parent folder in the database
+            return None
+        missing.append(dir)
+        dir = parent
+    folder_id = FOLDER_INDEX[dir][0]
+    if missing:
+        # Stash can create folders while we are running (scan)
+        cursor.execute("SELECT MAX(id) from folders")
+        FOLDER_NEXT_ID = max(FOLDER_NEXT_ID, (cursor.fetchone()[0] or 0) + 1)
+    for dir in reversed(missing):
+        new_folders.append(
+            [FOLDER_NEXT_ID, dir, folder_id, mod_time, mod_time, mod_time, None]
+        )
+        FOLDER_INDEX[dir] = (FOLDER_NEXT_ID, folder_id)
+        folder_id = FOLDER_NEXT_ID
+        FOLDER_NEXT_ID += 1
+    return folder_id
+
+
+def folder_index_insert(cursor: sqlite3.Cursor, new_folders: list):
+    if new_folders:
+        cursor.executemany(
+            "INSERT INTO 'main'.'folders'('id', 'path', 'parent_folder_id', 'mod_time', 'created_at', 'updated_at', 'zip_file_id') VALUES (?, ?, ?, ?, ?, ?, ?);",
+            new_folders,
+        )
+        log.LogDebug(f"[SQLITE] {len(new_folders)} folder(s) created")
+
+
+def folder_index_forget(new_folders: list):
+    # the insert was rolled back
+    for row in new_folders:
+        FOLDER_INDEX.pop(row[1], None)
+
+
+@timed
 def db_rename_refactor(stash_db: sqlite3.Connection, scene_info):
     cursor = stash_db.cursor()
     # 2022-09-17T11:25:52+02:00
     mod_time = datetime.now().astimezone().isoformat("T", "seconds")
 
-    # get the next id that we should use if needed
-    cursor.execute("SELECT MAX(id) from folders")
-    new_id = cursor.fetchall()[0][0] + 1
-
     # get the old folder id
     cursor.execute(
         "SELECT id FROM folders WHERE path=?", [scene_info["current_directory"]]
@@ -1058,29 +1907,20 @@ def db_rename_refactor(stash_db: sqlite3.Connection, scene_info):
     cursor.execute("SELECT id FROM folders WHERE path=?", [scene_info["new_directory"]])
     folder_id = cursor.fetchall()
     if not folder_id:
-        dir = scene_info["new_directory"]
-        # reduce the path to find a parent folder
-        for _ in range(1, len(scene_info["new_directory"].split(os.sep))):
-            dir = os.path.dirname(dir)
-            cursor.execute("SELECT id FROM folders WHERE path=?", [dir])
-            parent_id = cursor.fetchall()
-            if parent_id:
-                # create a new row with the new folder with the parent folder find above
-                cursor.execute(
-                    "INSERT INTO 'main'.'folders'('id', 'path', 'parent_folder_id', 'mod_time', 'created_at', 'updated_at', 'zip_file_id') VALUES (?, ?, ?, ?, ?, ?, ?);",
-                    [
-                        new_id,
-                        scene_info["new_directory"],
-                        parent_id[0][0],
-                        mod_time,
-                        mod_time,
-                        mod_time,
-                        None,
-                    ],
-                )
+        folder_index_load(cursor)
+        new_folders = []
+        folder_id = folder_index_resolve(
+            cursor, scene_info["new_directory"], mod_time, new_folders
+        )
+        if new_folders:
+            try:
+                folder_index_insert(cursor, new_folders)
                 stash_db.commit()
-                folder_id = new_id
-                break
+            except Exception:
+                stash_db.rollback()
+                folder_index_forget(new_folders)
+                cursor.close()
+                raise
     else:
         folder_id = folder_id[0][0]
     if folder_id:
@@ -1115,8 +1955,458 @@ def db_rename_refactor(stash_db: sqlite3.Connection, scene_info):
         )
 
 
-def file_rename(current_path: str, new_path: str, scene_info: dict):
-    # OS Rename
+def sql_chunks(values: list):
+    # SQLite limits the number of variables in a single query
+    for i in range(0, len(values), SQLITE_MAX_VARIABLES):
+        yield values[i : i + SQLITE_MAX_VARIABLES]
+
+
+@timed
+def db_rename_refactor_batch(stash_db: sqlite3.Connection, scenes_info: list):
+    # Same as db_rename_refactor but for many scenes in one transaction.
+    # Return the scenes that couldn't be updated (the others are committed).
+    cursor = stash_db.cursor()
+    mod_time = datetime.now().astimezone().isoformat("T", "seconds")
+    failed = []
+
+    folder_index_load(cursor)
+
+    # scene id -> files (id, parent_folder_id, basename)
+    scene_files = {}
+    scene_ids = list({int(x["scene_id"]) for x in scenes_info})
+    for chunk in sql_chunks(scene_ids):
+        cursor.execute(
+            f"SELECT sf.scene_id, f.id, f.parent_folder_id, f.basename FROM scenes_files AS sf JOIN files AS f ON f.id = sf.file_id WHERE sf.scene_id IN ({','.join('?' * len(chunk))})",
+            chunk,
+        )
+        for row in cursor.fetchall():
+            scene_files.setdefault(row[0], []).append(row[1:])
+
+    new_folders = []
+    updates = []
+    used_file_ids = set()
+    for scene_info in scenes_info:
+        old_folder_id = (
+            folder_index_get(cursor, scene_info["current_directory"]) or (None,)
+        )[0]
+        file_id = None
+        # it can have multiple file for a scene, prefer the one with the same name
+        candidates = [
+            f
+            for f in scene_files.get(int(scene_info["scene_id"]), [])
+            if f[1] == old_folder_id and f[0] not in used_file_ids
+        ]
+        for f in candidates:
+            if f[2] == scene_info["current_filename"]:
+                file_id = f[0]
+                break
+        if not file_id and candidates:
+            file_id = candidates[0][0]
+        if not file_id:
+            log.LogError(f"[{scene_info['scene_id']}] Failed to find file_id")
+            failed.append(scene_info)
+            continue
+        folder_id = folder_index_resolve(
+            cursor, scene_info["new_directory"], mod_time, new_folders
+        )
+        if not folder_id:
+            log.LogError(
+                f"[{scene_info['scene_id']}] You need to setup a library with the new location ({scene_info['new_directory']}) and scan at least 1 file"
+            )
+            failed.append(scene_info)
+            continue
+        used_file_ids.add(file_id)
+        updates.append([scene_info["new_filename"], folder_id, mod_time, file_id])
+
+    try:
+        folder_index_insert(cursor, new_folders)
+        cursor.executemany(
+            "UPDATE files SET basename=?, parent_folder_id=?, updated_at=? WHERE id=?;",
+            updates,
+        )
+        stash_db.commit()
+    except Exception:
+        stash_db.rollback()
+        folder_index_forget(new_folders)
+        raise
+    finally:
+        cursor.close()
+    log.LogDebug(f"[SQLITE] {len(updates)} file(s) updated")
+    return failed
+
+
+def flush_pending_rename(stash_db: sqlite3.Connection):
+    # Move the files waiting in PENDING_DB then write them in the database,
+    # the moves that can't be written are reverted. Return the updated_at of
+    # the scenes not renamed (also added to RENAME_INCOMPLETE).
+    if not PENDING_DB:
+        return []
+    batch = PENDING_DB[:]
+    PENDING_DB.clear()
+    DIR_LISTING.clear()
+    OPEN_FILES.clear()
+    journal_write([x[0] for x in batch], "planned")
+    moved = {id(x) for x in move_files([x[0] for x in batch])}
+    not_moved = [x[0] for x in batch if id(x[0]) not in moved]
+    for scene_information in not_moved:
+        path_index_move(
+            scene_information["scene_id"],
+            scene_information["final_path"],
+            scene_information["current_path"],
+        )
+    journal_done(not_moved)
+    incomplete = [x.get("updated_at") for x in not_moved]
+    RENAME_INCOMPLETE.extend(incomplete)
+    batch = [x for x in batch if id(x[0]) in moved]
+    if not batch:
+        return incomplete
+    journal_write([x[0] for x in batch], "moved")
+    try:
+        failed = db_rename_refactor_batch(stash_db, [x[0] for x in batch])
+    except Exception as err:
+        log.LogError(
+            f"error when trying to update the database ({err}), revert the moves..."
+        )
+        failed = [x[0] for x in batch]
+    incomplete += [x.get("updated_at") for x in failed]
+    RENAME_INCOMPLETE.extend(x.get("updated_at") for x in failed)
+    failed = {id(x) for x in failed}
+    reverted = []
+    for scene_information, _, _ in batch:
+        if id(scene_information) not in failed:
+            continue
+        path_index_move(
+            scene_information["scene_id"],
+            scene_information["final_path"],
+            scene_information["current_path"],
+        )
+        if file_rename(
+            scene_information["final_path"],
+            scene_information["current_path"],
+            scene_information,
+        ):
+            # stays in the journal, the next run will try again
+            log.LogError(
+                f"[{scene_information['scene_id']}] Failed to restore {scene_information['current_path']}"
+            )
+            continue
+        reverted.append(scene_information)
+    journal_done(reverted)
+    batch = [x for x in batch if id(x[0]) not in failed]
+    journal_write([x[0] for x in batch], "db_updated")
+    for scene_information, template, file_index in batch:
+        try:
+            after_rename(scene_information, template, file_index)
+        except Exception as err:
+            log.LogError(f"[{scene_information['scene_id']}] {err}")
+    journal_done([x[0] for x in batch])
+    return incomplete
+
+
+def device_of(directory: str):
+    # st_dev of the directory or of its nearest existing parent
+    dir = directory
+    while dir not in DEVICE_CACHE:
+        try:
+            DEVICE_CACHE[dir] = os.stat(dir).st_dev
+        except OSError:
+            parent = os.path.dirname(dir)
+            if parent == dir:
+                return None
+            dir = parent
+    return DEVICE_CACHE[dir]
+
+
+def move_file_on_disks(scene_info: dict, disks: list, folders: list):
+    # hold a slot on the source and destination drive during the copy
+    for disk in disks:
+        disk.acquire()
+    try:
+        return file_rename(
+            scene_info["current_path"], scene_info["final_path"], scene_info, folders
+        )
+    finally:
+        for disk in reversed(disks):
+            disk.release()
+
+
+@timed
+def move_files(scenes_info: list) -> list:
+    # Renames on the same drive are only metadata, they are done one by one.
+    # Moves between drives are copies, they run on a thread pool with at most
+    # MOVE_PER_DISK copies on the same drive. Return the scenes moved.
+    moved = []
+    copies = []
+    for scene_info in scenes_info:
+        source_device = device_of(scene_info["current_directory"])
+        destination_device = device_of(scene_info["new_directory"])
+        # a drive that can't be reached (None) is left to file_rename, one by one
+        if (
+            MOVE_WORKERS > 1
+            and None not in (source_device, destination_device)
+            and source_device != destination_device
+        ):
+            copies.append((scene_info, sorted({source_device, destination_device})))
+            continue
+        if not file_rename(
+            scene_info["current_path"], scene_info["final_path"], scene_info
+        ):
+            moved.append(scene_info)
+    if copies:
+        log.LogDebug(f"[OS] {len(copies)} file(s) to copy to another drive")
+        for _, devices in copies:
+            for device in devices:
+                if device not in DISK_SLOTS:
+                    DISK_SLOTS[device] = threading.BoundedSemaphore(MOVE_PER_DISK)
+        # the empty folders are removed once all the copies are done
+        folders = []
+        with ThreadPoolExecutor(max_workers=MOVE_WORKERS) as pool:
+            futures = {
+                pool.submit(
+                    move_file_on_disks,
+                    scene_info,
+                    [DISK_SLOTS[d] for d in devices],
+                    folders,
+                ): scene_info
+                for scene_info, devices in copies
+            }
+            for future in as_completed(futures):
+                scene_info = futures[future]
+                try:
+                    err = future.result()
+                except Exception as e:
+                    log.LogError(
+                        f"[OS] Failed to move {scene_info['current_path']} ({e})"
+                    )
+                    err = 1
+                if not err:
+                    moved.append(scene_info)
+        for folder in sorted(set(folders), reverse=True):
+            remove_empty_folder(folder)
+    return moved
+
+
+def journal_connect():
+    global JOURNAL_DB
+    if JOURNAL_DB is None:
+        JOURNAL_DB = sqlite3.connect(JOURNAL_FILE, timeout=10)
+        JOURNAL_DB.execute("PRAGMA journal_mode=WAL")
+        JOURNAL_DB.execute("PRAGMA synchronous=NORMAL")
+        JOURNAL_DB.execute(
+            "CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY, scene_id TEXT, state TEXT, scene_info TEXT, updated_at TEXT, owner TEXT)"
+        )
+        columns = [x[1] for x in JOURNAL_DB.execute("PRAGMA table_info(journal)")]
+        if "owner" not in columns:
+            JOURNAL_DB.execute("ALTER TABLE journal ADD COLUMN owner TEXT")
+        # last incremental run
+        JOURNAL_DB.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)"
+        )
+    return JOURNAL_DB
+
+
+def journal_write(scenes_info: list, state: str):
+    # Write-ahead trace of the renames (planned -> moved -> db_updated),
+    # so they can be finished or reverted if the plugin is killed.
+    # One transaction for all the scenes given.
+    if not scenes_info:
+        return
+    journal = journal_connect()
+    now = datetime.now().astimezone().isoformat("T", "seconds")
+    try:
+        for scene_info in scenes_info:
+            if scene_info.get("journal_id"):
+                journal.execute(
+                    "UPDATE journal SET state=?, updated_at=? WHERE id=?",
+                    [state, now, scene_info["journal_id"]],
+                )
+                continue
+            cursor = journal.execute(
+                "INSERT INTO journal (scene_id, state, scene_info, updated_at, owner) VALUES (?, ?, ?, ?, ?)",
+                [
+                    str(scene_info["scene_id"]),
+                    state,
+                    json.dumps({k: scene_info.get(k) for k in JOURNAL_KEYS}),
+                    now,
+                    JOURNAL_OWNER,
+                ],
+            )
+            scene_info["journal_id"] = cursor.lastrowid
+        journal.commit()
+    except sqlite3.Error:
+        journal.rollback()
+        raise
+
+
+def journal_done(scenes_info: list):
+    # the associated files are renamed, nothing left to do for these scenes
+    ids = [[x.pop("journal_id")] for x in scenes_info if x.get("journal_id")]
+    if ids:
+        journal = journal_connect()
+        journal.executemany("DELETE FROM journal WHERE id=?", ids)
+        journal.commit()
+
+
+def db_file_renamed(stash_db: sqlite3.Connection, scene_info: dict) -> bool:
+    # is the new path already in the database
+    if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+        query = "SELECT files.id FROM files JOIN folders ON folders.id=files.parent_folder_id WHERE folders.path=? AND files.basename=?;"
+        params = [scene_info["new_directory"], scene_info["new_filename"]]
+    else:
+        query = "SELECT id FROM scenes WHERE path=?;"
+        params = [scene_info["final_path"]]
+    return stash_db.execute(query, params).fetchone() is not None
+
+
+def journal_recover_entry(stash_db: sqlite3.Connection, scene_info: dict, state: str):
+    current_path = scene_info["current_path"]
+    final_path = scene_info["final_path"]
+    if state == "planned":
+        at_old = os.path.isfile(current_path)
+        at_new = os.path.isfile(final_path)
+        if at_old and at_new:
+            # killed during a copy to another drive, the original is intact
+            log.LogWarning(f"[Journal] Removing the incomplete copy {final_path}")
+            os.remove(final_path)
+            return
+        if not at_new:
+            # never moved
+            return
+        state = "moved"
+    if state == "moved":
+        if not db_file_renamed(stash_db, scene_info):
+            try:
+                if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+                    db_rename_refactor(stash_db, scene_info)
+                else:
+                    db_rename(stash_db, scene_info)
+                log.LogInfo(f"[Journal] Database updated ({final_path})")
+            except Exception as err:
+                log.LogError(
+                    f"[Journal] error when trying to update the database ({err}), revert the move..."
+                )
+                if file_rename(final_path, current_path, scene_info):
+                    raise Exception(f"Failed to restore {current_path}")
+                return
+        state = "db_updated"
+    if state == "db_updated":
+        associated_rename(scene_info)
+
+
+def journal_owner_dead(owner, updated_at) -> bool:
+    # The entries of a running process (bulk task, hook worker...) are never touched
+    alive = process_alive(owner)
+    if alive is None:
+        # can't check the process, wait until the entry is old enough
+        try:
+            updated = datetime.fromisoformat(updated_at).timestamp()
+        except (TypeError, ValueError):
+            return True
+        return updated < time.time() - JOURNAL_STALE
+    return not alive
+
+
+def journal_recover():
+    # Finish (or revert) the renames of a previous run that was killed.
+    journal = journal_connect()
+    entries = [
+        x
+        for x in journal.execute(
+            "SELECT id, state, scene_info, updated_at, owner FROM journal ORDER BY id"
+        ).fetchall()
+        if journal_owner_dead(x[4], x[3])
+    ]
+    if not entries:
+        return
+    log.LogInfo(f"[Journal] {len(entries)} unfinished rename(s) from a previous run")
+    stash_db = connect_db(STASH_DATABASE)
+    if stash_db is None:
+        return
+    for journal_id, state, scene_info, _, owner in entries:
+        # claim the entry, another process could be recovering it too
+        cursor = journal.execute(
+            "UPDATE journal SET owner=? WHERE id=? AND owner IS ?",
+            [JOURNAL_OWNER, journal_id, owner],
+        )
+        journal.commit()
+        if cursor.rowcount != 1:
+            continue
+        scene_info = json.loads(scene_info)
+        try:
+            journal_recover_entry(stash_db, scene_info, state)
+        except Exception as err:
+            # keep the entry, it will be tried again on the next run
+            log.LogError(f"[Journal] [{scene_info['scene_id']}] {err}")
+            continue
+        journal.execute("DELETE FROM journal WHERE id=?", [journal_id])
+        journal.commit()
+    stash_db.close()
+
+
+def incremental_state_read():
+    row = (
+        journal_connect()
+        .execute("SELECT value FROM state WHERE key='updated_at'")
+        .fetchone()
+    )
+    return row[0] if row else None
+
+
+def incremental_state_write(updated_at: str):
+    if DRY_RUN:
+        return
+    journal = journal_connect()
+    journal.execute(
+        "INSERT OR REPLACE INTO state (key, value) VALUES ('updated_at', ?)",
+        [updated_at],
+    )
+    journal.commit()
+
+
+def incremental_watermark(run_start: str, scene_filter, last_id, failed: list) -> str:
+    # The next run must see the scenes that failed and the ones after last_id
+    # (limit of batch_number_scene), so the watermark stays below their updated_at.
+    oldest = list(failed)
+    page_filter = {"id": {"value": int(last_id), "modifier": "GREATER_THAN"}}
+    if scene_filter:
+        page_filter.update(scene_filter)
+    remaining = graphql_findScene(1, "ASC", 1, "updated_at", page_filter)["scenes"]
+    if remaining:
+        oldest.append(remaining[0]["updated_at"])
+    if not oldest:
+        return run_start
+    oldest = [datetime.fromisoformat(x.replace("Z", "+00:00")) for x in oldest]
+    oldest = min(oldest + [datetime.fromisoformat(run_start)])
+    # the filter is GREATER_THAN
+    return (oldest - timedelta(seconds=1)).isoformat("T", "seconds")
+
+
+def after_rename(scene_information: dict, template: dict, file_index: int):
+    if file_index == 0:
+        associated_rename(scene_information)
+    if template.get("path"):
+        if "clean_tag" in template["path"]["option"]:
+            graphql_removeScenesTag(
+                [scene_information["scene_id"]],
+                template["path"]["opt_details"]["clean_tag"],
+            )
+
+
+@timed
+def remove_empty_folder(folder: str):
+    if os.path.isdir(folder):
+        with os.scandir(folder) as it:
+            if not any(it):
+                log.LogInfo(f"Removing empty folder ({folder})")
+                try:
+                    os.rmdir(folder)
+                except Exception as err:
+                    log.LogWarning(f"Fail to delete empty folder {folder} - {err}")
+
+
+def file_rename(current_path: str, new_path: str, scene_info: dict, folders=None):
+    # OS Rename. With folders (list), the folder left empty is added to it
+    # instead of being removed (another thread could be moving a file in it).
     if not os.path.isfile(current_path):
         log.LogWarning(f"[OS] File doesn't exist in your Disk/Drive ({current_path})")
         return 1
@@ -1125,7 +2415,7 @@ def file_rename(current_path: str, new_path: str, scene_info: dict):
     current_dir = os.path.dirname(current_path)
     if not os.path.exists(new_dir):
         log.LogInfo(f"Creating folder because it don't exist ({new_dir})")
-        os.makedirs(new_dir)
+        os.makedirs(new_dir, exist_ok=True)
     try:
         shutil.move(current_path, new_path)
     except PermissionError as err:
@@ -1161,7 +2451,7 @@ def file_rename(current_path: str, new_path: str, scene_info: dict):
         log.LogInfo(f"[OS] File Renamed! ({current_path} -> {new_path})")
         if LOGFILE:
             try:
-                with open(LOGFILE, "a", encoding="utf-8") as f:
+                with LOGFILE_LOCK, open(LOGFILE, "a", encoding="utf-8") as f:
                     f.write(
                         f"{scene_info['scene_id']}|{current_path}|{new_path}|{scene_info['oshash']}\n"
                     )
@@ -1172,27 +2462,56 @@ def file_rename(current_path: str, new_path: str, scene_info: dict):
                 )
                 return 1
         if REMOVE_EMPTY_FOLDER:
-            with os.scandir(current_dir) as it:
-                if not any(it):
-                    log.LogInfo(f"Removing empty folder ({current_dir})")
-                    try:
-                        os.rmdir(current_dir)
-                    except Exception as err:
-                        log.logWarning(
-                            f"Fail to delete empty folder {current_dir} - {err}"
-                        )
+            if folders is None:
+                remove_empty_folder(current_dir)
+            else:
+                folders.append(current_dir)
     else:
         # I don't think it's possible.
         log.LogError(f"[OS] Failed to rename the file ? {new_path}")
         return 1
 
 
+def dir_listing(directory: str) -> set:
+    # names of the files of the directory, scanned once per batch
+    if directory not in DIR_LISTING:
+        try:
+            with os.scandir(directory) as it:
+                DIR_LISTING[directory] = {
+                    os.path.normcase(entry.name) for entry in it if entry.is_file()
+                }
+        except OSError:
+            DIR_LISTING[directory] = set()
+    return DIR_LISTING[directory]
+
+
+def dir_listing_has(path: str) -> bool:
+    # a single scene (hook) checks the file, listing the directory costs more
+    if not DIR_LISTING_BATCH:
+        return os.path.isfile(path)
+    return os.path.normcase(os.path.basename(path)) in dir_listing(
+        os.path.dirname(path)
+    )
+
+
+def dir_listing_move(path: str, new_path: str):
+    directory = os.path.dirname(path)
+    if directory in DIR_LISTING:
+        DIR_LISTING[directory].discard(os.path.normcase(os.path.basename(path)))
+    directory = os.path.dirname(new_path)
+    if directory in DIR_LISTING:
+        DIR_LISTING[directory].add(os.path.normcase(os.path.basename(new_path)))
+
+
+@timed
 def associated_rename(scene_info: dict):
     if ASSOCIATED_EXT:
+        current_stem = os.path.splitext(scene_info["current_path"])[0]
+        new_stem = os.path.splitext(scene_info["final_path"])[0]
         for ext in ASSOCIATED_EXT:
-            p = os.path.splitext(scene_info["current_path"])[0] + "." + ext
-            p_new = os.path.splitext(scene_info["final_path"])[0] + "." + ext
-            if os.path.isfile(p):
+            p = current_stem + "." + ext
+            p_new = new_stem + "." + ext
+            if dir_listing_has(p):
                 try:
                     shutil.move(p, p_new)
                 except Exception as err:
@@ -1200,7 +2519,8 @@ def associated_rename(scene_info: dict):
                         f"Something prevents renaming this file '{p}' - err: {err}"
                     )
                     continue
-            if os.path.isfile(p_new):
+                dir_listing_move(p, p_new)
+            if dir_listing_has(p_new):
                 log.LogInfo(f"[OS] Associate file renamed ({p_new})")
                 if LOGFILE:
                     try:
@@ -1208,11 +2528,65 @@ def associated_rename(scene_info: dict):
                             f.write(f"{scene_info['scene_id']}|{p}|{p_new}\n")
                     except Exception as err:
                         shutil.move(p_new, p)
+                        dir_listing_move(p_new, p)
                         log.LogError(
                             f"Restoring the original name, error writing the logfile: {err}"
                         )
 
 
+def rename_scene(
+    stash_db: sqlite3.Connection,
+    scene_information: dict,
+    template: dict,
+    file_index: int,
+):
+    # Move the file then update the database, the move is reverted if the
+    # database can't be updated.
+    journal_write([scene_information], "planned")
+    # rename file on your disk
+    err = file_rename(
+        scene_information["current_path"],
+        scene_information["final_path"],
+        scene_information,
+    )
+    if err:
+        journal_done([scene_information])
+        raise Exception("rename")
+    journal_write([scene_information], "moved")
+    path_index_move(
+        scene_information["scene_id"],
+        scene_information["current_path"],
+        scene_information["final_path"],
+    )
+    # rename file on your db
+    try:
+        if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+            db_rename_refactor(stash_db, scene_information)
+        else:
+            db_rename(stash_db, scene_information)
+    except Exception as err:
+        log.LogError(
+            f"error when trying to update the database ({err}), revert the move..."
+        )
+        path_index_move(
+            scene_information["scene_id"],
+            scene_information["final_path"],
+            scene_information["current_path"],
+        )
+        err = file_rename(
+            scene_information["final_path"],
+            scene_information["current_path"],
+            scene_information,
+        )
+        if err:
+            raise Exception("rename")
+        journal_done([scene_information])
+        raise Exception("database update")
+    journal_write([scene_information], "db_updated")
+    after_rename(scene_information, template, file_index)
+    journal_done([scene_information])
+
+
 def renamer(scene_id, db_conn=None):
     option_dryrun = False
     if type(scene_id) is dict:
@@ -1298,6 +2672,8 @@ def renamer(scene_id, db_conn=None):
 
         scene_information["scene_id"] = scene_id
         scene_information["file_index"] = i
+        # incremental task: a scene not renamed keeps the watermark below this
+        scene_information["updated_at"] = stash_scene.get("updated_at")
 
         for removed_field in ORDER_SHORTFIELD:
             if removed_field:
@@ -1330,7 +2706,9 @@ def renamer(scene_id, db_conn=None):
                 break
 
         if check_longpath(scene_information["final_path"]):
-            if (DRY_RUN or option_dryrun) and LOGFILE:
+            if PLAN:
+                plan_write(scene_information, template, i, "too_long")
+            elif (DRY_RUN or option_dryrun) and LOGFILE:
                 with open(DRY_RUN_FILE, "a", encoding="utf-8") as f:
                     f.write(
                         f"[LENGTH LIMIT] {scene_information['scene_id']}|{scene_information['final_path']}\n"
@@ -1342,6 +2720,8 @@ def renamer(scene_id, db_conn=None):
 
         if scene_information["final_path"] == scene_information["current_path"]:
             log.LogInfo(f"Everything is ok. ({scene_information['current_filename']})")
+            if PLAN:
+                plan_write(scene_information, template, i, "noop")
             continue
 
         if scene_information["current_directory"] != scene_information["new_directory"]:
@@ -1360,7 +2740,7 @@ def renamer(scene_id, db_conn=None):
                 log.LogDebug(f"[OLD filename] {scene_information['current_filename']}")
                 log.LogDebug(f"[NEW filename] {scene_information['new_filename']}")
 
-        if (DRY_RUN or option_dryrun) and LOGFILE:
+        if (DRY_RUN or option_dryrun) and LOGFILE and not PLAN:
             with open(DRY_RUN_FILE, "a", encoding="utf-8") as f:
                 f.write(
                     f"{scene_information['scene_id']}|{scene_information['current_path']}|{scene_information['final_path']}\n"
@@ -1368,7 +2748,7 @@ def renamer(scene_id, db_conn=None):
             continue
         # check if there is already a file where the new path is
         err = checking_duplicate_db(scene_information)
-        while err and scene_information["file_index"] <= len(DUPLICATE_SUFFIX):
+        while err and scene_information["file_index"] + 1 < len(DUPLICATE_SUFFIX):
             log.LogDebug("Duplicate filename detected, increasing file index")
             scene_information["file_index"] = scene_information["file_index"] + 1
             scene_information["new_filename"] = create_new_filename(
@@ -1380,9 +2760,34 @@ def renamer(scene_id, db_conn=None):
             log.LogDebug(f"[NEW filename] {scene_information['new_filename']}")
             log.LogDebug(f"[NEW path] {scene_information['final_path']}")
             err = checking_duplicate_db(scene_information)
+        if PLAN:
+            if err:
+                plan_write(scene_information, template, i, "collision")
+            elif option_dryrun:
+                plan_write(scene_information, template, i, "dry_run")
+            else:
+                # the next scenes of the plan can't use this path
+                path_index_move(
+                    scene_id,
+                    scene_information["current_path"],
+                    scene_information["final_path"],
+                )
+                plan_write(scene_information, template, i, "rename")
+            continue
         # abort
         if err:
             raise Exception("duplicate")
+        if db_conn and DB_BATCH_SIZE > 1 and DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+            # the file will be moved and the database updated with the rest of the batch
+            path_index_move(
+                scene_id,
+                scene_information["current_path"],
+                scene_information["final_path"],
+            )
+            PENDING_DB.append((scene_information, template, i))
+            if len(PENDING_DB) >= DB_BATCH_SIZE:
+                flush_pending_rename(db_conn)
+            continue
         # connect to the db
         if not db_conn:
             stash_db = connect_db(STASH_DATABASE)
@@ -1391,42 +2796,10 @@ def renamer(scene_id, db_conn=None):
         else:
             stash_db = db_conn
         try:
-            # rename file on your disk
-            err = file_rename(
-                scene_information["current_path"],
-                scene_information["final_path"],
-                scene_information,
-            )
-            if err:
-                raise Exception("rename")
-            # rename file on your db
-            try:
-                if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
-                    db_rename_refactor(stash_db, scene_information)
-                else:
-                    db_rename(stash_db, scene_information)
-            except Exception as err:
-                log.LogError(
-                    f"error when trying to update the database ({err}), revert the move..."
-                )
-                err = file_rename(
-                    scene_information["final_path"],
-                    scene_information["current_path"],
-                    scene_information,
-                )
-                if err:
-                    raise Exception("rename")
-                raise Exception("database update")
-            if i == 0:
-                associated_rename(scene_information)
-            if template.get("path"):
-                if "clean_tag" in template["path"]["option"]:
-                    graphql_removeScenesTag(
-                        [scene_information["scene_id"]],
-                        template["path"]["opt_details"]["clean_tag"],
-                    )
+            rename_scene(stash_db, scene_information, template, i)
         except Exception as err:
             log.LogError(f"Error during database operation ({err})")
+            RENAME_INCOMPLETE.append(scene_information["updated_at"])
             if not db_conn:
                 log.LogDebug("[SQLITE] Database closed")
                 stash_db.close()
@@ -1436,10 +2809,249 @@ def renamer(scene_id, db_conn=None):
         log.LogInfo("[SQLITE] Database updated and closed!")
 
 
+def plan_write(scene_information: dict, template: dict, file_index: int, status: str):
+    # One line of the plan (JSON Lines), it has everything plan_apply needs
+    entry = {"status": status, "file_number": file_index}
+    entry.update({k: scene_information.get(k) for k in JOURNAL_KEYS})
+    if template.get("path") and "clean_tag" in template["path"]["option"]:
+        entry["clean_tag"] = template["path"]["opt_details"]["clean_tag"]
+    PLAN.write(json.dumps(entry) + "\n")
+    PLAN_COUNT[status] = PLAN_COUNT.get(status, 0) + 1
+
+
+def plan_create(plan_file: str):
+    # Render all the scenes in one pass, nothing is renamed
+    global PLAN
+    stash_db = connect_db(STASH_DATABASE)
+    if stash_db is None:
+        return
+    path_index_load(stash_db)
+    stash_db.close()
+    progress = 0
+    PLAN = open(plan_file, "w", encoding="utf-8")
+    try:
+        for total, scenes in prefetch_pages(
+            bulk_scene_pages(BULK_PER_PAGE), BULK_PREFETCH
+        ):
+            for scene in scenes:
+                try:
+                    renamer(scene)
+                except Exception as err:
+                    log.LogError(f"[{scene['id']}] {err}")
+                progress += 1
+                log.LogProgress(progress / total)
+    finally:
+        PLAN.close()
+        PLAN = None
+    log.LogInfo(f"Plan written in {plan_file} ({PLAN_COUNT})")
+
+
+def plan_apply(plan_file: str):
+    # Rename the scenes marked 'rename' in the plan, the templates are not used
+    if not os.path.isfile(plan_file):
+        log.LogError(f"No plan to apply ({plan_file})")
+        return
+    stash_db = connect_db(STASH_DATABASE)
+    if stash_db is None:
+        return
+    path_index_load(stash_db)
+    with open(plan_file, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries = [x for x in entries if x["status"] == "rename"]
+    log.LogInfo(f"{len(entries)} rename(s) in the plan")
+    batch = DB_BATCH_SIZE > 1 and DB_VERSION >= DB_VERSION_FILE_REFACTOR
+    for progress, scene_information in enumerate(entries, 1):
+        template = {}
+        if scene_information.get("clean_tag"):
+            template["path"] = {
+                "option": ["clean_tag"],
+                "opt_details": {"clean_tag": scene_information["clean_tag"]},
+            }
+        file_index = scene_information.pop("file_number")
+        # the library could have changed since the plan was made
+        if checking_duplicate_db(scene_information):
+            log.LogError(
+                f"[{scene_information['scene_id']}] Skipped, {scene_information['final_path']} is used"
+            )
+            continue
+        try:
+            if batch:
+                path_index_move(
+                    scene_information["scene_id"],
+                    scene_information["current_path"],
+                    scene_information["final_path"],
+                )
+                PENDING_DB.append((scene_information, template, file_index))
+                if len(PENDING_DB) >= DB_BATCH_SIZE:
+                    flush_pending_rename(stash_db)
+            else:
+                rename_scene(stash_db, scene_information, template, file_index)
+        except Exception as err:
+            log.LogError(f"[{scene_information['scene_id']}] {err}")
+        log.LogProgress(progress / len(entries))
+    flush_pending_rename(stash_db)
+    stash_db.close()
+
+
+def bulk_rename(incremental=False):
+    # Task: rename all the scenes, or with incremental only the scenes updated
+    # since the last incremental run.
+    stash_db = connect_db(STASH_DATABASE)
+    if stash_db is None:
+        exit_plugin()
+    path_index_load(stash_db)
+    last_id = 0
+    scene_filter = None
+    # failed: updated_at of the scenes to retry, skipped: ids of the scenes that
+    # can't be renamed until they change (duplicate), they don't hold the watermark
+    failed = []
+    skipped = []
+    RENAME_INCOMPLETE.clear()
+    if incremental:
+        run_start = datetime.now().astimezone().isoformat("T", "seconds")
+        watermark = incremental_state_read()
+        if watermark:
+            log.LogInfo(f"Scenes updated since {watermark}")
+            scene_filter = {
+                "updated_at": {"value": watermark, "modifier": "GREATER_THAN"}
+            }
+    elif BULK_RESUME:
+        last_id = bulk_state_read()
+        if last_id:
+            log.LogInfo(f"Resuming the previous run after scene {last_id}")
+    progress = 0
+    for total, scenes in prefetch_pages(
+        bulk_scene_pages(
+            BULK_PER_PAGE, last_id, config.batch_number_scene, scene_filter
+        ),
+        BULK_PREFETCH,
+    ):
+        for scene in scenes:
+            log.LogDebug(f"** Checking scene: {scene['title']} - {scene['id']} **")
+            try:
+                renamer(scene, stash_db)
+            except Exception as err:
+                log.LogError(f"main function error: {err}")
+                if str(err) == "duplicate":
+                    skipped.append(scene["id"])
+                else:
+                    failed.append(scene["updated_at"])
+            progress += 1
+            log.LogProgress(progress / total)
+        DIR_LISTING.clear()
+        OPEN_FILES.clear()
+        last_id = scenes[-1]["id"]
+        if incremental:
+            continue
+        # scenes waiting for the database are not completed yet
+        if PENDING_DB:
+            bulk_state_write(min(int(x[0]["scene_id"]) for x in PENDING_DB) - 1)
+        else:
+            bulk_state_write(scenes[-1]["id"])
+    flush_pending_rename(stash_db)
+    failed += [x for x in RENAME_INCOMPLETE if x]
+    RENAME_INCOMPLETE.clear()
+    if skipped:
+        log.LogWarning(f"{len(skipped)} scene(s) skipped, their new path is used")
+        log.LogDebug(f"Skipped: {skipped}")
+    if incremental:
+        if failed:
+            log.LogInfo(f"{len(failed)} scene(s) will be tried again on the next run")
+        incremental_state_write(
+            incremental_watermark(run_start, scene_filter, last_id, failed)
+        )
+    elif 0 < config.batch_number_scene <= progress:
+        # stopped by batch_number_scene, the next run continues after this scene
+        bulk_state_write(last_id)
+        log.LogInfo(f"{progress} scenes checked, the next run starts after {last_id}")
+    else:
+        bulk_state_clear()
+    stash_db.close()
+    log.LogInfo("[SQLITE] Database closed!")
+
+
+def benchmark_scene(i: int) -> dict:
+    # Synthetic scene, shaped like a scene given to extract_info by renamer
+    return {
+        "id": str(i),
+        "title": f"Synthetic Scene Title {i}",
+        "date": f"20{i % 25:02d}-0{i % 9 + 1}-1{i % 10}",
+        "rating100": (i * 7) % 100,
+        "organized": True,
+        "code": f"CODE-{i}",
+        "stash_ids": [{"endpoint": "", "stash_id": f"stashid-{i}"}],
+        "path": os.path.join(os.sep, "library", f"Studio {i % 50}", f"file_{i}.mp4"),
+        "oshash": f"{i:016x}",
+        "checksum": None,
+        "file": {
+            "video_codec": "h264",
+            "audio_codec": "aac",
+            "width": 1920,
+            "height": [480, 720, 1080, 2160][i % 4],
+            "duration": 1800 + i % 600,
+            "bit_rate": 8000000,
+        },
+        "studio": {
+            "id": str(i % 50),
+            "name": f"Studio {i % 50}",
+            "parent_studio": None,
+        },
+        "tags": [{"id": str(t), "name": f"Tag {t}"} for t in range(i % 5)],
+        "performers": [
+            {
+                "id": str(p),
+                "name": f"Performer Name{p}",
+                "gender": "FEMALE",
+                "favorite": p % 2 == 0,
+                "rating100": p % 100,
+                "stash_ids": [],
+            }
+            for p in range(i % 200, i % 200 + i % 3 + 1)
+        ],
+        "movies": [],
+    }
+
+
+def benchmark_template(count: int):
+    # Measure the filename/path rendering on synthetic scenes
+    filename_template = config.default_template
+    path_template = config.p_default_template
+    scenes_information = []
+    start = time.perf_counter()
+    for i in range(0, count):
+        template = {
+            "filename": filename_template,
+            "path": {"destination": path_template, "option": [], "opt_details": {}},
+        }
+        scene_information = extract_info(benchmark_scene(i), template)
+        scene_information["file_index"] = 0
+        scenes_information.append((scene_information, template))
+    extract_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for scene_information, template in scenes_information:
+        create_new_filename(scene_information, template["filename"])
+        create_new_path(scene_information, template)
+    render_time = time.perf_counter() - start
+    log.LogInfo(
+        f"[BENCHMARK] {count} scenes - extract_info: {round(count / extract_time)}/s - render filename+path: {round(count / render_time)}/s"
+    )
+    log.LogDebug(f"[BENCHMARK] templates: '{filename_template}' '{path_template}'")
+
+
 def exit_plugin(msg=None, err=None):
     if msg is None and err is None:
         msg = "plugin ended"
-    log.LogDebug("Execution time: {}s".format(round(time.time() - START_TIME, 5)))
+    lookup_cache_stats()
+    lookup_cache_save()
+    profiling_report()
+    if STARTUP_TIME is not None:
+        log.LogDebug(
+            "Execution time: {}s (startup {}s)".format(
+                round(time.time() - START_TIME, 5), round(STARTUP_TIME, 5)
+            )
+        )
+    else:
+        log.LogDebug("Execution time: {}s".format(round(time.time() - START_TIME, 5)))
     output_json = {"output": msg, "error": err}
     print(json.dumps(output_json))
     sys.exit()
@@ -1447,7 +3059,7 @@ def exit_plugin(msg=None, err=None):
 
 if PLUGIN_ARGS:
     log.LogDebug("--Starting Plugin 'Renamer'--")
-    if "bulk" not in PLUGIN_ARGS:
+    if any(x in PLUGIN_ARGS for x in ["enable", "disable", "dryrun"]):
         if "enable" in PLUGIN_ARGS:
             log.LogInfo("Enable hook")
             success = config_edit("enable_hook", True)
@@ -1470,6 +3082,9 @@ else:
     log.LogDebug("--Starting Hook 'Renamer'--")
     FRAGMENT_HOOK_TYPE = FRAGMENT["args"]["hookContext"]["type"]
     FRAGMENT_SCENE_ID = FRAGMENT["args"]["hookContext"]["id"]
+    if config.hook_queue:
+        hook_enqueue(FRAGMENT_SCENE_ID)
+        exit_plugin("Scene queued")
 
 LOGFILE = config.log_file
 
@@ -1477,8 +3092,8 @@ LOGFILE = config.log_file
 # if FRAGMENT_HOOK_TYPE == "Scene.Update.Post":
 
 
-STASH_CONFIG = graphql_getConfiguration()
-STASH_DATABASE = STASH_CONFIG["general"]["databasePath"]
+SERVER_CAPABILITIES = server_capabilities()
+STASH_DATABASE = SERVER_CAPABILITIES["database_path"]
 
 # READING CONFIG
 
@@ -1493,6 +3108,10 @@ FILENAME_TITLECASE = config.titlecase_Filename
 FILENAME_SPLITCHAR = config.filename_splitchar
 FILENAME_REMOVECHARACTER = config.removecharac_Filename
 FILENAME_REPLACEWORDS = config.replace_words
+REPLACE_WORDS = compile_replace_words(FILENAME_REPLACEWORDS)
+RE_REMOVECHARACTER = None
+if FILENAME_REMOVECHARACTER:
+    RE_REMOVECHARACTER = re.compile(f"[{FILENAME_REMOVECHARACTER}]+")
 
 PERFORMER_SPLITCHAR = config.performer_splitchar
 PERFORMER_LIMIT = config.performer_limit
@@ -1528,12 +3147,67 @@ ORDER_SHORTFIELD.insert(0, None)
 
 ALT_DIFF_DISPLAY = config.alt_diff_display
 
+BULK_PER_PAGE = config.bulk_per_page
+BULK_PREFETCH = config.bulk_prefetch_pages
+BULK_RESUME = config.bulk_resume
+BULK_STATE_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_bulk.json")
+
+DB_BATCH_SIZE = config.db_batch_size
+# renames moved on disk, waiting to be written in the database
+PENDING_DB = []
+# updated_at of the scenes whose rename failed, see bulk_rename
+RENAME_INCOMPLETE = []
+# folders table: path -> (id, parent_folder_id)
+FOLDER_INDEX = {}
+FOLDER_NEXT_ID = 0
+# path/basename -> scene ids, used instead of graphql to find duplicate (bulk)
+PATH_INDEX = {}
+BASENAME_INDEX = {}
+PATH_INDEX_LOADED = False
+
+MOVE_WORKERS = config.move_workers
+MOVE_PER_DISK = config.move_per_disk
+# directory -> names of the files, used to find the associated files
+DIR_LISTING = {}
+# only the tasks rename enough scenes for the listing to pay off
+DIR_LISTING_BATCH = bool(PLUGIN_ARGS)
+# directory -> st_dev, drive -> semaphore limiting the copies
+DEVICE_CACHE = {}
+DISK_SLOTS = {}
+LOGFILE_LOCK = threading.Lock()
+# path -> pids, see has_handle
+OPEN_FILES = {}
+OPEN_FILES_LOCK = threading.Lock()
+
+# write-ahead journal of the renames (planned, moved, db_updated)
+JOURNAL_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate.sqlite")
+JOURNAL_DB = None
+# only the entries of a dead owner are recovered
+JOURNAL_OWNER = process_owner()
+# seconds before an entry is recovered when its owner can't be checked
+JOURNAL_STALE = 86400
+JOURNAL_KEYS = [
+    "scene_id",
+    "oshash",
+    "current_path",
+    "current_directory",
+    "current_filename",
+    "final_path",
+    "new_directory",
+    "new_filename",
+]
+
+# plan mode: file where the renames are written instead of being done
+PLAN_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_plan.jsonl")
+PLAN = None
+PLAN_COUNT = {}
+
 PATH_NOPERFORMER_FOLDER = config.path_noperformer_folder
 PATH_KEEP_ALRPERF = config.path_keep_alrperf
 PATH_NON_ORGANIZED = config.p_non_organized
 PATH_ONEPERFORMER = config.path_one_performer
 
-DB_VERSION = graphql_getBuild()
+DB_VERSION = SERVER_CAPABILITIES["db_version"]
 if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
     FILE_QUERY = """
             files {
@@ -1569,26 +3243,28 @@ else:
     """
 if DB_VERSION >= DB_VERSION_SCENE_STUDIO_CODE:
     FILE_QUERY = f"        code{FILE_QUERY}"
+STARTUP_TIME = time.time() - START_TIME
+
+# a previous run was killed during a rename
+if os.path.isfile(JOURNAL_FILE) and not DRY_RUN:
+    journal_recover()
 
 if PLUGIN_ARGS:
-    if "bulk" in PLUGIN_ARGS:
-        scenes = graphql_findScene(config.batch_number_scene, "ASC")
-        log.LogDebug(f"Count scenes: {len(scenes['scenes'])}")
-        progress = 0
-        progress_step = 1 / len(scenes["scenes"])
-        stash_db = connect_db(STASH_DATABASE)
-        if stash_db is None:
-            exit_plugin()
-        for scene in scenes["scenes"]:
-            log.LogDebug(f"** Checking scene: {scene['title']} - {scene['id']} **")
-            try:
-                renamer(scene, stash_db)
-            except Exception as err:
-                log.LogError(f"main function error: {err}")
-            progress += progress_step
-            log.LogProgress(progress)
-        stash_db.close()
-        log.LogInfo("[SQLITE] Database closed!")
+    if "incremental" in PLUGIN_ARGS:
+        bulk_rename(incremental=True)
+    elif "bulk" in PLUGIN_ARGS:
+        bulk_rename()
+    elif "drain_queue" in PLUGIN_ARGS:
+        hook_queue_drain()
+    elif "apply_plan" in PLUGIN_ARGS:
+        if DRY_RUN:
+            log.LogInfo("Dry mode on, the plan is not applied")
+        else:
+            plan_apply(FRAGMENT["args"].get("plan_file") or PLAN_FILE)
+    elif "plan" in PLUGIN_ARGS:
+        plan_create(FRAGMENT["args"].get("plan_file") or PLAN_FILE)
+    elif "benchmark" in PLUGIN_ARGS:
+        benchmark_template(int(FRAGMENT["args"].get("count", 10000)))
 else:
     try:
         renamer(FRAGMENT_SCENE_ID)
@@ -0,0 +1,397 @@
+"""Benchmark of the renamerOnUpdate bulk task on a synthetic library.
+
+It creates, in a temporary folder:
+    - a Stash database with the tables used by the plugin (folders, files, scenes, scenes_files)
+    - the files of the scenes (empty) and some associated files (.srt)
+    - a fake GraphQL server answering the queries of the plugin
+then runs the plugin (mode bulk by default) with profiling enabled and prints the stage timings.
+
+Usage: python renamerOnUpdate_benchmark.py --scenes 10000 [--batch-size 500] [--mode plan]
+"""
+
+import argparse
+import io
+import json
+import os
+import re
+import runpy
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_SCHEMA = 60
+MOD_TIME = "2024-01-01T00:00:00+00:00"
+
+# Same columns as Stash (schema >= 32) for the tables the plugin reads/writes
+SCHEMA = """
+CREATE TABLE folders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path varchar(255) NOT NULL,
+    parent_folder_id integer,
+    zip_file_id integer,
+    mod_time datetime NOT NULL,
+    created_at datetime NOT NULL,
+    updated_at datetime NOT NULL,
+    FOREIGN KEY(parent_folder_id) REFERENCES folders(id) ON DELETE SET NULL
+);
+CREATE UNIQUE INDEX index_folders_on_path_unique ON folders (path);
+CREATE INDEX index_folders_on_parent_folder_id ON folders (parent_folder_id);
+CREATE TABLE files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    basename varchar(255) NOT NULL,
+    zip_file_id integer,
+    parent_folder_id integer NOT NULL,
+    size integer NOT NULL,
+    mod_time datetime NOT NULL,
+    created_at datetime NOT NULL,
+    updated_at datetime NOT NULL,
+    FOREIGN KEY(parent_folder_id) REFERENCES folders(id)
+);
+CREATE UNIQUE INDEX index_files_zip_basename_unique ON files (zip_file_id, parent_folder_id, basename);
+CREATE INDEX index_files_on_parent_folder_id_basename ON files (parent_folder_id, basename);
+CREATE TABLE scenes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title text,
+    organized boolean NOT NULL DEFAULT '0',
+    created_at datetime NOT NULL,
+    updated_at datetime NOT NULL
+);
+CREATE TABLE scenes_files (
+    scene_id integer NOT NULL,
+    file_id integer NOT NULL,
+    "primary" boolean NOT NULL,
+    FOREIGN KEY(scene_id) REFERENCES scenes(id) ON DELETE CASCADE,
+    FOREIGN KEY(file_id) REFERENCES files(id) ON DELETE CASCADE,
+    PRIMARY KEY(scene_id, file_id)
+);
+CREATE INDEX index_scenes_files_file_id ON scenes_files (file_id);
+"""
+
+
+class Library:
+    def __init__(self, root: str, scenes: int, directories: int, sidecars: int):
+        self.root = root
+        self.library = os.path.join(root, "library")
+        self.database = os.path.join(root, "stash-go.sqlite")
+        self.scenes = scenes
+        self.directories = directories
+        self.sidecars = sidecars
+
+    def directory(self, scene_id: int) -> str:
+        return os.path.join(self.library, f"folder {scene_id % self.directories}")
+
+    def scene(self, scene_id: int) -> dict:
+        # The scene as returned by the SceneData fragment, it only depends on the id
+        studio = scene_id % 50
+        return {
+            "id": str(scene_id),
+            "title": f"Scene Title {scene_id}",
+            "date": f"20{scene_id % 24:02d}-{scene_id % 12 + 1:02d}-{scene_id % 28 + 1:02d}",
+            "rating100": scene_id % 100,
+            "organized": True,
+            "code": None,
+            "stash_ids": [],
+            "files": [
+                {
+                    "path": os.path.join(
+                        self.directory(scene_id), f"file{scene_id}.mp4"
+                    ),
+                    "video_codec": "h264",
+                    "audio_codec": "aac",
+                    "width": 1920,
+                    "height": 1080,
+                    "frame_rate": 29.97,
+                    "duration": 1800.0,
+                    "bit_rate": 5000000,
+                    "phash": None,
+                    "oshash": f"{scene_id:016x}",
+                    "checksum": None,
+                    "fingerprints": [{"type": "oshash", "value": f"{scene_id:016x}"}],
+                }
+            ],
+            "studio": {
+                "id": str(studio + 1),
+                "name": f"Studio {studio}",
+                "parent_studio": (
+                    {"id": "100", "name": "Network"} if studio % 2 else None
+                ),
+            },
+            "tags": [{"id": str(scene_id % 20), "name": f"Tag {scene_id % 20}"}],
+            "performers": [
+                {
+                    "id": str(scene_id % 300),
+                    "name": f"Performer {scene_id % 300}",
+                    "gender": "FEMALE",
+                    "favorite": False,
+                    "rating100": None,
+                    "stash_ids": [],
+                }
+            ],
+            "movies": [],
+        }
+
+    def create(self):
+        os.makedirs(self.library)
+        db = sqlite3.connect(self.database)
+        db.executescript(SCHEMA)
+        db.execute(
+            "INSERT INTO folders VALUES (1, ?, NULL, NULL, ?, ?, ?)",
+            [self.library, MOD_TIME, MOD_TIME, MOD_TIME],
+        )
+        folders = []
+        for n in range(self.directories):
+            path = os.path.join(self.library, f"folder {n}")
+            os.makedirs(path)
+            folders.append([n + 2, path, 1, None, MOD_TIME, MOD_TIME, MOD_TIME])
+        db.executemany("INSERT INTO folders VALUES (?, ?, ?, ?, ?, ?, ?)", folders)
+        for start in range(1, self.scenes + 1, 10000):
+            ids = range(start, min(start + 10000, self.scenes + 1))
+            db.executemany(
+                "INSERT INTO files VALUES (?, ?, NULL, ?, 0, ?, ?, ?)",
+                [
+                    [
+                        i,
+                        f"file{i}.mp4",
+                        i % self.directories + 2,
+                        MOD_TIME,
+                        MOD_TIME,
+                        MOD_TIME,
+                    ]
+                    for i in ids
+                ],
+            )
+            db.executemany(
+                "INSERT INTO scenes VALUES (?, ?, 1, ?, ?)",
+                [[i, f"Scene Title {i}", MOD_TIME, MOD_TIME] for i in ids],
+            )
+            db.executemany(
+                "INSERT INTO scenes_files VALUES (?, ?, 1)", [[i, i] for i in ids]
+            )
+            for i in ids:
+                stem = os.path.join(self.directory(i), f"file{i}")
+                open(stem + ".mp4", "w").close()
+                if self.sidecars and i % self.sidecars == 0:
+                    open(stem + ".srt", "w").close()
+        db.commit()
+        db.close()
+
+    def check(self) -> int:
+        # number of files of the database that are not on the disk
+        db = sqlite3.connect(self.database)
+        missing = 0
+        for directory, basename in db.execute(
+            "SELECT folders.path, files.basename FROM files JOIN folders ON folders.id = files.parent_folder_id"
+        ):
+            if not os.path.isfile(os.path.join(directory, basename)):
+                missing += 1
+        db.close()
+        return missing
+
+
+def graphql_handler(library: Library, counter: dict, latency: float):
+    class Handler(BaseHTTPRequestHandler):
+        # keep-alive, like Stash
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            counter["requests"] += 1
+            time.sleep(latency)
+            data = json.dumps(
+                {"data": self.answer(body["query"], body.get("variables") or {})}
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def answer(self, query: str, variables: dict) -> dict:
+            data = {}
+            if "configuration" in query:
+                data["configuration"] = {"general": {"databasePath": library.database}}
+            if "systemStatus" in query:
+                data["systemStatus"] = {"databaseSchema": DB_SCHEMA}
+            if "findScenes(filter: $filter, scene_filter: $scene_filter)" in query:
+                data["findScenes"] = self.find_scenes(variables)
+            for alias in re.findall(r"(q\d+): findScenes\(", query):
+                data[alias] = {"count": 0, "scenes": []}
+            for alias, var in re.findall(r"(q\d+): findScene\(id: \$(\w+)\)", query):
+                data[alias] = library.scene(int(variables[var]))
+            if "findScene(id: $id" in query:
+                data["findScene"] = library.scene(int(variables["id"]))
+            if "findStudio" in query:
+                data["findStudio"] = {
+                    "id": variables["id"],
+                    "name": "Network",
+                    "parent_studio": None,
+                }
+            if "bulkSceneUpdate" in query:
+                data["bulkSceneUpdate"] = []
+            if "runPluginTask" in query:
+                data["runPluginTask"] = "0"
+            return data
+
+        def find_scenes(self, variables: dict) -> dict:
+            scene_filter = variables.get("scene_filter") or {}
+            if "path" in scene_filter:
+                # duplicate check, the paths are all different
+                return {"count": 0, "scenes": []}
+            after = scene_filter.get("id", {}).get("value", 0)
+            per_page = variables["filter"]["per_page"]
+            last = (
+                library.scenes
+                if per_page == -1
+                else min(library.scenes, after + per_page)
+            )
+            scenes = [library.scene(i) for i in range(after + 1, last + 1)]
+            return {"count": library.scenes - after, "scenes": scenes}
+
+    return Handler
+
+
+def plugin_config(library: Library, args) -> types.ModuleType:
+    # renamerOnUpdate_config with the templates of the benchmark
+    sys.path.insert(0, PLUGIN_DIR)
+    import renamerOnUpdate_config
+
+    config = types.ModuleType("config")
+    config.__dict__.update(
+        {
+            k: v
+            for k, v in vars(renamerOnUpdate_config).items()
+            if not k.startswith("__")
+        }
+    )
+    config.__file__ = os.path.join(library.root, "config.py")
+    config.use_default_template = True
+    config.default_template = "$date $title [$studio] $performer $height"
+    config.p_use_default_template = True
+    config.p_default_template = os.path.join(
+        library.library, "$studio_hierarchy", "$year"
+    )
+    config.dry_run = False
+    config.log_file = ""
+    config.only_organized = False
+    config.bulk_resume = False
+    config.capability_cache_ttl = 0
+    config.profiling = True
+    config.profiling_trace = args.trace
+    if args.batch_size is not None:
+        config.db_batch_size = args.batch_size
+    for option in args.set:
+        name, value = option.split("=", 1)
+        setattr(config, name, json.loads(value))
+    return config
+
+
+def run(args):
+    root = tempfile.mkdtemp(prefix="renamerOnUpdate_benchmark_")
+    library = Library(root, args.scenes, args.directories, args.sidecars)
+    start = time.perf_counter()
+    library.create()
+    print(
+        f"Library of {args.scenes} scenes created in {time.perf_counter() - start:.1f}s ({root})"
+    )
+
+    counter = {"requests": 0}
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), graphql_handler(library, counter, args.latency / 1000)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    plugin_dir = os.path.join(root, "plugin")
+    os.makedirs(plugin_dir)
+    fragment = {
+        "server_connection": {
+            "Scheme": "http",
+            "Host": "127.0.0.1",
+            "Port": server.server_address[1],
+            "SessionCookie": {"Value": ""},
+            "PluginDir": plugin_dir,
+        },
+        "args": {"mode": args.mode},
+    }
+    sys.modules["config"] = plugin_config(library, args)
+    stdin, stderr = sys.stdin, sys.stderr
+    sys.stdin = io.StringIO(json.dumps(fragment))
+    sys.stderr = logs = io.StringIO()
+    start = time.perf_counter()
+    try:
+        runpy.run_path(
+            os.path.join(PLUGIN_DIR, "renamerOnUpdate.py"), run_name="__main__"
+        )
+    except SystemExit:
+        pass
+    finally:
+        duration = time.perf_counter() - start
+        sys.stdin, sys.stderr = stdin, stderr
+        server.shutdown()
+
+    messages = [x[3:] for x in logs.getvalue().splitlines() if x.startswith("\x01")]
+    print(
+        f"{args.mode}: {duration:.2f}s, {args.scenes / duration:.0f} scenes/s, {counter['requests']} GraphQL request(s)"
+    )
+    for message in messages:
+        if message.startswith("[Profiling]"):
+            print(message)
+    error_count = sum(1 for x in logs.getvalue().splitlines() if x.startswith("\x01e"))
+    if error_count:
+        print(f"{error_count} error(s) logged by the plugin")
+    if args.mode == "bulk":
+        print(f"Files of the database missing on the disk: {library.check()}")
+    if args.keep or args.trace:
+        print(f"Kept in {root}")
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the renamerOnUpdate bulk task"
+    )
+    parser.add_argument(
+        "--scenes", type=int, default=1000, help="number of scenes (1000)"
+    )
+    parser.add_argument(
+        "--directories",
+        type=int,
+        default=200,
+        help="number of folders of the library (200)",
+    )
+    parser.add_argument(
+        "--sidecars", type=int, default=5, help="one .srt every x scenes, 0 = none (5)"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=None, help="db_batch_size (config value)"
+    )
+    parser.add_argument(
+        "--mode", default="bulk", choices=["bulk", "plan"], help="task to run (bulk)"
+    )
+    parser.add_argument(
+        "--trace", default="", choices=["", "json", "cprofile"], help="profiling_trace"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="delay of each GraphQL answer in ms (0)",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=JSON",
+        help="config value, e.g. bulk_prefetch_pages=0",
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the temporary folder")
+    run(parser.parse_args())
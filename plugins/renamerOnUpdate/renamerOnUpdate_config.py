@@ -248,10 +248,42 @@ order_field = [
 alt_diff_display = False
 
 # number of scene process by the task renamer. -1 = all scenes
+# with bulk_resume, the next run continues after the last scene processed (to rename the library in several runs)
 batch_number_scene = -1
+# number of scene fetched at once by the task renamer. Only a few pages are kept in memory (bulk_prefetch_pages).
+bulk_per_page = 100
+# number of pages fetched in advance while the current one is renamed. 0 = fetch the next page after the current one
+bulk_prefetch_pages = 2
+# if the task renamer is interrupted, the next run will start after the last scene checked.
+bulk_resume = True
+# number of renames written in the database in one transaction by the task renamer. 1 = one transaction per scene
+db_batch_size = 500
+# number of files moved at the same time by the task renamer when the file goes to another drive (copy). 1 = one by one
+move_workers = 4
+# maximum number of copies at the same time on the same drive
+move_per_disk = 1
+# number of retries of a GraphQL request when Stash can't be reached (wait graphql_backoff * 2^retry seconds between each)
+# a mutation is only retried if the connection failed, never after the request was sent
+graphql_retries = 3
+graphql_backoff = 0.5
+# send the queries that don't depend on each other in one request
+graphql_batch = True
+# keep the studios (parent studios) in renamerOnUpdate_cache.json for x hours, so the next runs don't ask Stash again. 0 = only during a run
+lookup_cache_ttl = 0
+# keep the database path/schema of Stash in renamerOnUpdate_server.json for x seconds, the hook doesn't need to ask Stash each time. 0 = disabled
+# the cache is not used if the schema version in the database changed (upgrade), or after a GraphQL error
+capability_cache_ttl = 300
+# log the number of calls/time spent in each step (graphql, extract_info, file_rename, db_rename...) at the end
+profiling = False
+# with profiling, also write a trace next to the log file (or in the plugin folder): "cprofile" (renamerOnUpdate.prof) or "json" (renamerOnUpdate_trace.json, chrome://tracing)
+profiling_trace = ""
 
 # disable/enable the hook. You can edit this value in 'Plugin Tasks' inside of Stash.
 enable_hook = True
+# the hook only queues the scene, a single task ('Process hook queue') renames the queued scenes. Useful when a lot of scenes are updated at once (scrape, tagging)
+hook_queue = False
+# seconds without new scene before the task stops
+hook_queue_idle = 10
 # disable/enable dry mode. Do a trial run with no permanent changes. Can write into a file (dryrun_renamerOnUpdate.txt), set a path for log_file.
 # You can edit this value in 'Plugin Tasks' inside of Stash.
 dry_run = False
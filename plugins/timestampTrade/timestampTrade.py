@@ -12,23 +12,249 @@ import sqlite3
 import hashlib
 import shutil
 import re
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
 
 per_page = 100
 request_s = requests.Session()
 scrapers = {}
 tags_cache = {}
+# token bucket per remote host, see remote_request
+rate_limits = {}
+rate_limit_lock = threading.Lock()
+rate_limit_burst = 5
+max_retries = 3
+# marker primary tag name/alias -> id, see markerTag
+marker_tags = None
+marker_batch_size = 50
+cache_conn = None
+cache_lock = threading.Lock()
+
+
+def rate_limit_wait(host):
+    """Take a token from the bucket of the host, sleep until there is one."""
+    limit = settings["requestsPerMinute"] / 60
+    while True:
+        with rate_limit_lock:
+            now = time.monotonic()
+            bucket = rate_limits.setdefault(
+                host,
+                {
+                    "tokens": rate_limit_burst,
+                    "rate": limit,
+                    "updated": now,
+                    "blocked_until": 0,
+                },
+            )
+            wait = bucket["blocked_until"] - now
+            if wait <= 0:
+                if limit <= 0:
+                    return
+                bucket["tokens"] = min(
+                    rate_limit_burst,
+                    bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"],
+                )
+                bucket["updated"] = now
+                if bucket["tokens"] >= 1:
+                    bucket["tokens"] -= 1
+                    return
+                wait = (1 - bucket["tokens"]) / bucket["rate"]
+        time.sleep(wait)
+
+
+def rate_limit_backoff(host, delay):
+    """The host is overloaded: pause it for delay seconds and halve its rate."""
+    with rate_limit_lock:
+        bucket = rate_limits[host]
+        bucket["blocked_until"] = max(bucket["blocked_until"], time.monotonic() + delay)
+        bucket["tokens"] = 0
+        bucket["updated"] = bucket["blocked_until"]
+        bucket["rate"] = max(bucket["rate"] / 2, 1 / 60)
+
+
+def rate_limit_success(host):
+    """Get the rate of the host back to the setting after a backoff."""
+    limit = settings["requestsPerMinute"] / 60
+    with rate_limit_lock:
+        bucket = rate_limits[host]
+        bucket["rate"] = min(limit, bucket["rate"] + limit / 10)
+
+
+def retry_after(res):
+    value = res.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def remote_request(method, url, **kwargs):
+    """
+    Request to timestamp.trade (or an image host), rate limited per host.
+    Retried on 429/5xx after the Retry-After delay, or an exponential backoff.
+    """
+    host = urlparse(url).netloc
+    for attempt in range(max_retries + 1):
+        rate_limit_wait(host)
+        res = request_s.request(method, url, **kwargs)
+        if res.status_code != 429 and res.status_code < 500:
+            rate_limit_success(host)
+            return res
+        delay = retry_after(res)
+        if delay is None:
+            delay = 2 ** (attempt + 1)
+        log.info("%s returned %s, waiting %0.1fs" % (host, res.status_code, delay))
+        rate_limit_backoff(host, delay)
+    return res
+
+
+def cache_db():
+    global cache_conn
+    if cache_conn is None:
+        cache_conn = sqlite3.connect(settings["cache_dbpath"], check_same_thread=False)
+        cache_conn.execute("PRAGMA journal_mode=WAL")
+        cache_conn.execute("PRAGMA synchronous=NORMAL")
+        cache_conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache (url text PRIMARY KEY, status integer, body blob, etag text, last_modified text, fetched real, changed real);"
+        )
+        columns = [
+            x[1] for x in cache_conn.execute("PRAGMA table_info(response_cache)")
+        ]
+        if "changed" not in columns:
+            cache_conn.execute("ALTER TABLE response_cache ADD COLUMN changed real;")
+        cache_conn.execute(
+            "CREATE TABLE IF NOT EXISTS sync_state (key text PRIMARY KEY, value text);"
+        )
+        # last time each scene was processed by Sync updated scenes
+        cache_conn.execute(
+            "CREATE TABLE IF NOT EXISTS sync_processed (scene_id text PRIMARY KEY, done real);"
+        )
+    return cache_conn
+
+
+def cache_response(url, status, body):
+    res = requests.Response()
+    res.url = url
+    res.status_code = status
+    res._content = body
+    return res
+
+
+def cached_get(url):
+    """
+    GET a timestamp.trade url through the response cache.
+    Responses younger than cacheTTL hours are used as is, older ones are
+    revalidated with If-None-Match/If-Modified-Since. With cacheOnly the
+    network is never used, a url missing from the cache is a 404.
+    """
+    with cache_lock:
+        row = (
+            cache_db()
+            .execute(
+                "select status,body,etag,last_modified,fetched,changed from response_cache where url=?",
+                (url,),
+            )
+            .fetchone()
+        )
+    if row and (
+        settings["cacheOnly"] or time.time() - row[4] < settings["cacheTTL"] * 3600
+    ):
+        return cache_response(url, row[0], row[1])
+    if settings["cacheOnly"]:
+        log.debug("not in the cache: %s" % (url,))
+        return cache_response(url, 404, b"")
+    headers = {}
+    if row and row[2]:
+        headers["If-None-Match"] = row[2]
+    if row and row[3]:
+        headers["If-Modified-Since"] = row[3]
+    res = remote_request("GET", url, headers=headers)
+    if res.status_code == 304 and row:
+        with cache_lock:
+            cache_db().execute(
+                "update response_cache set fetched=? where url=?", (time.time(), url)
+            )
+            cache_db().commit()
+        return cache_response(url, row[0], row[1])
+    if res.status_code == 200:
+        # changed: when the body was last different, used by processUpdated
+        changed = time.time()
+        if row and row[1] == res.content:
+            changed = row[5]
+        with cache_lock:
+            cache_db().execute(
+                "insert or replace into response_cache (url,status,body,etag,last_modified,fetched,changed) values (?,?,?,?,?,?,?)",
+                (
+                    url,
+                    res.status_code,
+                    res.content,
+                    res.headers.get("ETag"),
+                    res.headers.get("Last-Modified"),
+                    time.time(),
+                    changed,
+                ),
+            )
+            cache_db().commit()
+    return res
+
+
+def remote_get(url, responses):
+    """GET url, or use the response already fetched by prefetchScene."""
+    if responses and url in responses:
+        return responses.pop(url)
+    return cached_get(url)
+
+
+def prefetchScene(s):
+    """
+    Fetch the timestamp.trade responses processScene will need for the scene,
+    without writing anything to stash. Run in the syncWorkers thread pool.
+    """
+    responses = {}
+    urls = [u for u in s["urls"] if u.startswith("https://timestamp.trade/scene/")]
+    if len(urls) == 0 and not any(
+        tag["id"] == str(skip_sync_tag_id) for tag in s["tags"]
+    ):
+        for sid in s["stash_ids"]:
+            url = "https://timestamp.trade/get-markers/" + sid["stash_id"]
+            res = cached_get(url)
+            responses[url] = res
+            if res.status_code != 200:
+                break
+            try:
+                md = res.json()
+            except json.decoder.JSONDecodeError:
+                continue
+            if not md:
+                break
+            if "scene_id" in md:
+                urls.append("https://timestamp.trade/scene/%s" % (md["scene_id"],))
+    for url in urls:
+        json_url = "https://timestamp.trade/json-scene/%s" % (url[30:],)
+        if json_url not in responses:
+            responses[json_url] = cached_get(json_url)
+    return responses
 
 
-def processScene(s):
+def processScene(s, responses=None):
     if "https://timestamp.trade/scene/" in [u[:30] for u in s["urls"]]:
-        processSceneTimestamTrade(s)
+        processSceneTimestamTrade(s, responses)
     else:
-        processSceneStashid(s)
+        processSceneStashid(s, responses)
         if "https://timestamp.trade/scene/" in [u[:30] for u in s["urls"]]:
-            processSceneTimestamTrade(s)
+            processSceneTimestamTrade(s, responses)
 
 
-def processSceneTimestamTrade(s):
+def processSceneTimestamTrade(s, responses=None):
     log.debug(s)
     if "https://timestamp.trade/scene/" in [u[:30] for u in s["urls"]]:
 
@@ -36,7 +262,7 @@ def processSceneTimestamTrade(s):
             log.debug(url)
             if url.startswith("https://timestamp.trade/scene/"):
                 json_url = "https://timestamp.trade/json-scene/%s" % (url[30:],)
-                res = request_s.get(json_url)
+                res = remote_get(json_url, responses)
                 if res.status_code == 200:
                     data = res.json()
                     if len(data) == 0:
@@ -66,7 +292,7 @@ def processSceneTimestamTrade(s):
                                 marker["primary_tag"] = m["name"]
 
                             if settings["addTsTradeTitle"]:
-                                marker["title"] = f"[TsTrade] {m["name"]}"
+                                marker["title"] = f"[TsTrade] {m['name']}"
 
                             # check for markers with a zero length title, skip adding
                             if len(marker["primary_tag"]) == 0:
@@ -86,12 +312,11 @@ def processSceneTimestamTrade(s):
                         if len(markers) > 0:
                             log.debug(markers)
                             if settings["overwriteMarkers"]:
-                                stash.destroy_scene_markers(s["id"])
-                                mp.import_scene_markers(stash, markers, s["id"], 15)
+                                writeSceneMarkers(s, markers, overwrite=True)
                             elif (
                                 len(s["scene_markers"]) == 0 or settings["mergeMarkers"]
                             ):
-                                mp.import_scene_markers(stash, markers, s["id"], 15)
+                                writeSceneMarkers(s, markers)
 
                     new_scene = {
                         "id": s["id"],
@@ -411,7 +636,148 @@ def processSceneTimestamTrade(s):
                         stash.update_scene(new_scene)
 
 
-def processSceneStashid(s):
+def markerTag(name):
+    """Id of the tag with this name or alias, all the tags are loaded once."""
+    global marker_tags
+    if marker_tags is None:
+        tags = stash.find_tags(fragment="id name aliases")
+        marker_tags = {}
+        for tag in tags:
+            for alias in tag["aliases"]:
+                marker_tags.setdefault(alias.strip().lower(), tag["id"])
+        for tag in tags:
+            marker_tags[tag["name"].strip().lower()] = tag["id"]
+    key = name.strip().lower()
+    if key not in marker_tags:
+        marker_tags[key] = stash.find_tag(name, create=True).get("id")
+    return marker_tags[key]
+
+
+def markerKey(marker):
+    return (
+        float(marker.seconds),
+        str(marker.primary_tag_id),
+        marker.title,
+        tuple(sorted(str(x) for x in marker.tag_ids)),
+    )
+
+
+def writeSceneMarkers(s, markers, overwrite=False):
+    """
+    Write the markers of the scene, only the difference with its existing
+    markers, in batched mutations (marker_batch_size per request).
+    Same rules as mp.import_scene_markers: markers closer than 15s are
+    merged, markers at 0s are skipped and a marker within 15s of one
+    existing marker updates it. With overwrite, the existing markers are
+    deleted unless they are identical to one of the new markers.
+    """
+    new_markers = [
+        mp.Marker(
+            {
+                "id": None,
+                "scene_id": s["id"],
+                "title": m["title"],
+                "seconds": float(m["seconds"]),
+                "end_seconds": None,
+                "primary_tag": {
+                    "id": markerTag(m["primary_tag"]),
+                    "name": m["primary_tag"],
+                },
+                "tags": [{"id": str(x)} for x in m["tags"]],
+            }
+        )
+        for m in markers
+    ]
+    new_markers = [m for m in mp.merge_markers(new_markers, 15) if m.seconds != 0]
+    existing = [
+        mp.Marker(
+            {
+                "id": m["id"],
+                "scene_id": s["id"],
+                "title": m["title"],
+                "seconds": m["seconds"],
+                "end_seconds": m.get("end_seconds"),
+                "primary_tag": m["primary_tag"],
+                "tags": m["tags"],
+            }
+        )
+        for m in s["scene_markers"]
+    ]
+
+    create = []
+    update = []
+    destroy = []
+    if overwrite:
+        keep = set()
+        existing_keys = [markerKey(m) for m in existing]
+        for m in new_markers:
+            if markerKey(m) in existing_keys:
+                keep.add(markerKey(m))
+            else:
+                create.append(m.gql_create_input())
+        destroy = [m.id for m in existing if markerKey(m) not in keep]
+    else:
+        for m in new_markers:
+            within_limit = [x for x in existing if m.within_distance(x, 15)]
+            if len(within_limit) == 0:
+                create.append(m.gql_create_input())
+            elif len(within_limit) == 1 and markerKey(m) != markerKey(within_limit[0]):
+                update.append(m.gql_update_input(within_limit[0].id))
+
+    mutations = (
+        [("sceneMarkerDestroy", "id", "ID!", x) for x in destroy]
+        + [("sceneMarkerCreate", "input", "SceneMarkerCreateInput!", x) for x in create]
+        + [("sceneMarkerUpdate", "input", "SceneMarkerUpdateInput!", x) for x in update]
+    )
+    if len(mutations) == 0:
+        log.debug("markers already up to date for scene %s" % (s["id"],))
+        return
+    for b in range(0, len(mutations), marker_batch_size):
+        params = []
+        fields = []
+        variables = {}
+        for n, (field, arg, arg_type, value) in enumerate(
+            mutations[b : b + marker_batch_size]
+        ):
+            params.append("$m%s: %s" % (n, arg_type))
+            fields.append(
+                "m%s: %s(%s: $m%s)%s"
+                % (n, field, arg, n, "" if field == "sceneMarkerDestroy" else " { id }")
+            )
+            variables["m%s" % (n,)] = value
+        result = stash.callGQL(
+            "mutation SceneMarkers(%s) {\n%s\n}"
+            % (", ".join(params), "\n".join(fields)),
+            variables,
+        )
+        # keep s["scene_markers"] current, the scene can have more than one
+        # timestamp.trade url and the next one is compared to these markers
+        for n, (field, arg, arg_type, value) in enumerate(
+            mutations[b : b + marker_batch_size]
+        ):
+            if field == "sceneMarkerDestroy":
+                s["scene_markers"] = [
+                    m for m in s["scene_markers"] if str(m["id"]) != str(value)
+                ]
+                continue
+            marker = {
+                "id": (result or {}).get("m%s" % (n,), {}).get("id", value.get("id")),
+                "title": value["title"],
+                "seconds": value["seconds"],
+                "end_seconds": value["end_seconds"],
+                "primary_tag": {"id": value["primary_tag_id"]},
+                "tags": [{"id": x} for x in value["tag_ids"]],
+            }
+            s["scene_markers"] = [
+                m for m in s["scene_markers"] if str(m["id"]) != str(marker["id"])
+            ] + [marker]
+    log.info(
+        "scene %s: %s markers created, %s updated, %s deleted"
+        % (s["id"], len(create), len(update), len(destroy))
+    )
+
+
+def processSceneStashid(s, responses=None):
     if len(s["stash_ids"]) == 0:
         log.debug("no scenes to process")
         return
@@ -423,8 +789,8 @@ def processSceneStashid(s):
                 log.debug("scene has skip sync tag")
                 return
             log.debug("looking up markers for stash id: " + sid["stash_id"])
-            res = request_s.get(
-                "https://timestamp.trade/get-markers/" + sid["stash_id"]
+            res = remote_get(
+                "https://timestamp.trade/get-markers/" + sid["stash_id"], responses
             )
             if res.status_code != 200:
                 log.debug("bad result from api, skipping")
@@ -457,7 +823,20 @@ def processSceneStashid(s):
             log.error("api returned invalid JSON for stash id: " + sid["stash_id"])
 
 
-def processAll(query):
+def processAll(query, state=None):
+    """
+    Process the scenes matching query. With state (processUpdated), the
+    scenes are fetched in id order after state["last_id"], which is saved
+    after every page so an interrupted run can continue, and the scenes only
+    updated by the plugin itself since it processed them are skipped.
+    """
+    pool = None
+    if settings["syncWorkers"] > 1:
+        pool = ThreadPoolExecutor(max_workers=settings["syncWorkers"])
+        request_s.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(pool_maxsize=settings["syncWorkers"]),
+        )
     log.debug(query)
     log.info("Getting scene count")
     count = stash.find_scenes(
@@ -466,6 +845,9 @@ def processAll(query):
         get_count=True,
     )[0]
     log.info(str(count) + " scenes to process.")
+    if count == 0:
+        return
+    processed = []
     #    i = 0
     # 98
     for r in range(1, int(count / per_page) + 2):
@@ -478,15 +860,203 @@ def processAll(query):
                 (i / count) * 100,
             )
         )
-        scenes = stash.find_scenes(
-            f=query,
-            filter={"page": r, "per_page": per_page},
-        )
-        for s in scenes:
-            processScene(s)
+        if state is None:
+            scenes = stash.find_scenes(
+                f=query,
+                filter={"page": r, "per_page": per_page},
+            )
+        else:
+            scenes = stash.find_scenes(
+                f=dict(
+                    query,
+                    id={"value": int(state["last_id"]), "modifier": "GREATER_THAN"},
+                ),
+                filter={
+                    "page": 1,
+                    "per_page": per_page,
+                    "sort": "id",
+                    "direction": "ASC",
+                },
+            )
+            if len(scenes) == 0:
+                break
+            last_id = scenes[-1]["id"]
+            done = sync_processed_read([s["id"] for s in scenes])
+            skipped = len(scenes)
+            scenes = [s for s in scenes if not self_updated(s, done.get(s["id"]))]
+            skipped = skipped - len(scenes)
+            if skipped:
+                log.debug("%s scenes only updated by this plugin" % (skipped,))
+                i = i + skipped
+        if pool:
+            # the workers fetch the page from timestamp.trade, stash is only updated here
+            prefetched = [pool.submit(prefetchScene, s) for s in scenes]
+        for n, s in enumerate(scenes):
+            if pool:
+                processScene(s, prefetched[n].result())
+                prefetched[n] = None
+            else:
+                processScene(s)
             i = i + 1
             log.progress((i / count))
-            time.sleep(2)
+            if state is not None:
+                processed.append((s["id"], time.time()))
+        if state is not None:
+            sync_processed_write(processed)
+            processed = []
+            state["last_id"] = last_id
+            sync_state_write(state)
+    if pool:
+        pool.shutdown()
+
+
+def sync_state_read():
+    with cache_lock:
+        return dict(cache_db().execute("select key,value from sync_state"))
+
+
+def sync_state_write(state):
+    with cache_lock:
+        cache_db().execute("delete from sync_state")
+        cache_db().executemany(
+            "insert into sync_state (key,value) values (?,?)",
+            [(k, str(v)) for k, v in state.items()],
+        )
+        cache_db().commit()
+
+
+def sync_processed_read(scene_ids):
+    with cache_lock:
+        return dict(
+            cache_db().execute(
+                "select scene_id,done from sync_processed where scene_id in (%s)"
+                % (",".join("?" * len(scene_ids)),),
+                [str(x) for x in scene_ids],
+            )
+        )
+
+
+def sync_processed_write(processed):
+    with cache_lock:
+        cache_db().executemany(
+            "insert or replace into sync_processed (scene_id,done) values (?,?)",
+            [(str(k), v) for k, v in processed],
+        )
+        cache_db().commit()
+
+
+def self_updated(scene, done):
+    # the scene was not changed since the plugin processed (and updated) it
+    if done is None or not scene.get("updated_at"):
+        return False
+    updated = datetime.fromisoformat(scene["updated_at"].replace("Z", "+00:00"))
+    return updated.timestamp() <= done
+
+
+def processUpdated(query):
+    """
+    Incremental sync: only the scenes updated since the last run of this
+    task, and the scenes whose cached timestamp.trade response changed when
+    revalidated (conditional requests, at most revalidateMax responses
+    older than revalidateDays).
+    """
+    state = sync_state_read()
+    if "run_started" in state:
+        log.info("continuing the last sync after scene %s" % (state["last_id"],))
+    else:
+        state = {
+            "updated_at": state.get("updated_at", ""),
+            "run_started": datetime.now().astimezone().isoformat(timespec="seconds"),
+            "last_id": 0,
+        }
+        sync_state_write(state)
+    updated_query = dict(query)
+    if state["updated_at"]:
+        log.info("scenes updated since %s" % (state["updated_at"],))
+        updated_query["updated_at"] = {
+            "value": state["updated_at"],
+            "modifier": "GREATER_THAN",
+        }
+    processAll(updated_query, state)
+
+    # revalidate the oldest cached responses (not fetched by this run)
+    # and process the scenes whose timestamp.trade data changed
+    started = datetime.fromisoformat(state["run_started"]).timestamp()
+    with cache_lock:
+        urls = [
+            x[0]
+            for x in cache_db().execute(
+                "select url from response_cache where fetched<? order by fetched limit ?",
+                (
+                    started - settings["revalidateDays"] * 86400,
+                    settings["revalidateMax"],
+                ),
+            )
+        ]
+    if len(urls) > 0 and not settings["cacheOnly"]:
+        log.info("checking %s timestamp.trade responses for changes" % (len(urls),))
+        checked = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, settings["syncWorkers"])) as pool:
+            for res in pool.map(cached_get, urls):
+                pass
+        with cache_lock:
+            urls = [
+                x[0]
+                for x in cache_db().execute(
+                    "select url from response_cache where changed>=?", (checked,)
+                )
+            ]
+        log.info("%s timestamp.trade responses changed" % (len(urls),))
+        if len(urls) > 0:
+            # timestamp.trade scene id -> stash ids, from the cached get-markers
+            ts_stash_ids = {}
+            with cache_lock:
+                rows = cache_db().execute(
+                    "select url,body from response_cache where url like 'https://timestamp.trade/get-markers/%'"
+                )
+                for url, body in rows:
+                    try:
+                        md = json.loads(body)
+                    except json.decoder.JSONDecodeError:
+                        continue
+                    if md and "scene_id" in md:
+                        ts_stash_ids.setdefault(str(md["scene_id"]), []).append(
+                            url[36:]
+                        )
+        filters = []
+        for url in urls:
+            if url.startswith("https://timestamp.trade/get-markers/"):
+                stash_ids = [url[36:]]
+            else:
+                stash_ids = ts_stash_ids.get(url[35:], [])
+                filters.append(
+                    dict(
+                        query,
+                        url={
+                            "modifier": "INCLUDES",
+                            "value": "https://timestamp.trade/scene/%s" % (url[35:],),
+                        },
+                    )
+                )
+            for stash_id in stash_ids:
+                filters.append(
+                    dict(
+                        query,
+                        stash_id_endpoint={
+                            "endpoint": "",
+                            "modifier": "EQUALS",
+                            "stash_id": stash_id,
+                        },
+                    )
+                )
+        done = set()
+        for f in filters:
+            for s in stash.find_scenes(f=f):
+                if s["id"] not in done:
+                    done.add(s["id"])
+                    processScene(s)
+        sync_processed_write([(x, time.time()) for x in done])
+    sync_state_write({"updated_at": state["run_started"]})
 
 
 def submitScene(query):
@@ -712,10 +1282,9 @@ def submitScene(query):
                     )
             s.pop("id")
             log.debug(s)
-            request_s.post("https://timestamp.trade/submit-stash", json=s)
+            remote_request("POST", "https://timestamp.trade/submit-stash", json=s)
             i = i + 1
             log.progress((i / count))
-            time.sleep(0.5)
 
 
 def submitGallery():
@@ -825,10 +1394,11 @@ def submitGallery():
         )
         for g in galleries:
             log.debug("submitting gallery: %s" % (g,))
-            request_s.post("https://timestamp.trade/submit-stash-gallery", json=g)
+            remote_request(
+                "POST", "https://timestamp.trade/submit-stash-gallery", json=g
+            )
             i = i + 1
             log.progress((i / count))
-            time.sleep(2)
 
 
 def processGalleries():
@@ -902,8 +1472,8 @@ def processGallery(gallery):
             for fp in f["fingerprints"]:
                 if fp["type"] == "md5":
                     log.debug("looking up galleries by file hash: %s " % (fp["value"],))
-                    res = request_s.post(
-                        "https://timestamp.trade/gallery-md5/" + fp["value"]
+                    res = remote_request(
+                        "POST", "https://timestamp.trade/gallery-md5/" + fp["value"]
                     )
                     if res.status_code == 200:
                         for g in res.json():
@@ -1002,11 +1572,9 @@ def processGallery(gallery):
 
                             log.debug(new_gallery)
                             stash.update_gallery(gallery_data=new_gallery)
-                            time.sleep(1)
 
                     else:
                         log.debug("bad response from api")
-                        time.sleep(10)
 
 
 def downloadGallery(gallery):
@@ -1021,7 +1589,7 @@ def downloadGallery(gallery):
         log.debug(url)
         if url.startswith("https://timestamp.trade/scene/"):
             json_url = "https://timestamp.trade/json-scene/%s" % (url[30:],)
-            res = request_s.get(json_url)
+            res = cached_get(json_url)
             if res.status_code == 200:
                 data = res.json()
                 log.debug(data)
@@ -1084,7 +1652,7 @@ def downloadGallery(gallery):
                             )
                         )
                         try:
-                            r = requests.get(i["url"])
+                            r = remote_request("GET", i["url"])
                             if r.status_code == 200:
                                 with open(metadata_file, "w") as f:
                                     json.dump(image_data, f)
@@ -1150,7 +1718,6 @@ def reDownloadGallery():
             downloadGallery(g)
             i = i + 1
             log.progress((i / count))
-            time.sleep(2)
 
 
 def getImages(gallery_id):
@@ -1332,6 +1899,12 @@ settings = {
     "excludedMarkerWords": "",
     "matchFunscripts": True,
     "addTsTradeTitle": False,
+    "requestsPerMinute": 60,
+    "syncWorkers": 4,
+    "cacheTTL": 24,
+    "cacheOnly": False,
+    "revalidateDays": 7,
+    "revalidateMax": 500,
 }
 if "timestampTrade" in config["plugins"]:
     settings.update(config["plugins"]["timestampTrade"])
@@ -1343,6 +1916,9 @@ settings["schema"] = res["systemStatus"]["databaseSchema"]
 settings["funscript_dbpath"] = (
     Path(res["systemStatus"]["databasePath"]).parent / "funscript_index.sqlite"
 )
+settings["cache_dbpath"] = (
+    Path(res["systemStatus"]["databasePath"]).parent / "timestampTrade_cache.sqlite"
+)
 log.debug("settings: %s " % (settings,))
 
 
@@ -1484,6 +2060,24 @@ if "mode" in json_input["args"]:
             },
         }
         processAll(query)
+    elif "processUpdated" == PLUGIN_ARGS:
+        skip_sync_tag_id = stash.find_tag("[Timestamp: Skip Sync]", create=True).get(
+            "id"
+        )
+        query = {
+            "stash_id_endpoint": {
+                "endpoint": "",
+                "modifier": "NOT_NULL",
+                "stash_id": "",
+            },
+            "tags": {
+                "depth": 0,
+                "excludes": [skip_sync_tag_id],
+                "modifier": "INCLUDES_ALL",
+                "value": [],
+            },
+        }
+        processUpdated(query)
     elif "reauto" == PLUGIN_ARGS:
         reDownloadGallery()
         stash.metadata_scan(paths=[settings["path"]])
@@ -15,6 +15,10 @@ DRY_RUN = False
 FEMALE_ONLY = False
 # Print debug message
 DEBUG_MODE = True
+# BULK_MODE = True | Compute all the new filenames first, check duplicates in memory, then rename & update the database (files.basename) by chunk.
+BULK_MODE = False
+# Number of files renamed/updated in the database per transaction (BULK_MODE)
+CHUNK_SIZE = 500
 
 
 def logPrint(q):
@@ -55,39 +59,58 @@ def get_SceneID_fromTags(id):
     return list
 
 
-def get_Perf_fromSceneID(id_scene):
-    perf_list = ""
+# Names are loaded once (load_Names), instead of 1 query per scene/performer
+PERFORMERS = {}
+STUDIOS = {}
+SCENE_PERFORMERS = {}
+
+
+def load_Names():
+    PERFORMERS.clear()
+    STUDIOS.clear()
+    SCENE_PERFORMERS.clear()
+    cursor.execute("SELECT id,name,gender from performers;")
+    for row in cursor.fetchall():
+        PERFORMERS[str(row[0])] = (row[1], row[2])
+    cursor.execute("SELECT id,name from studios;")
+    for row in cursor.fetchall():
+        STUDIOS[str(row[0])] = row[1]
     cursor.execute(
-        "SELECT performer_id from performers_scenes WHERE scene_id=?;", [id_scene]
+        "SELECT scene_id,performer_id from performers_scenes ORDER BY scene_id,performer_id;"
     )
-    record = cursor.fetchall()
+    for row in cursor.fetchall():
+        SCENE_PERFORMERS.setdefault(str(row[0]), []).append(str(row[1]))
+    logPrint(
+        "[DEBUG] {} performers, {} studios loaded".format(len(PERFORMERS), len(STUDIOS))
+    )
+
+
+def get_Perf_fromSceneID(id_scene):
+    perf_list = ""
+    record = SCENE_PERFORMERS.get(str(id_scene), [])
     # logPrint("Performer in scene: ", len(record))
     if len(record) > 3:
         logPrint("More than 3 performers.")
     else:
         perfcount = 0
-        for row in record:
-            perf_id = str(row[0])
-            cursor.execute("SELECT name,gender from performers WHERE id=?;", [perf_id])
-            perf = cursor.fetchall()
+        for perf_id in record:
+            perf = PERFORMERS[perf_id]
             if FEMALE_ONLY == True:
                 # Only take female gender
-                if str(perf[0][1]) == "FEMALE":
-                    perf_list += str(perf[0][0]) + " "
+                if str(perf[1]) == "FEMALE":
+                    perf_list += str(perf[0]) + " "
                     perfcount += 1
                 else:
                     continue
             else:
-                perf_list += str(perf[0][0]) + " "
+                perf_list += str(perf[0]) + " "
                 perfcount += 1
     perf_list = perf_list.strip()
     return perf_list
 
 
 def get_Studio_fromID(id):
-    cursor.execute("SELECT name from studios WHERE id=?;", [id])
-    record = cursor.fetchall()
-    studio_name = str(record[0][0])
+    studio_name = str(STUDIOS[str(id)])
     return studio_name
 
 
@@ -135,9 +158,137 @@ def makeFilename(scene_info, query):
     return new_filename
 
 
+def get_NewFilename(row, query_filename):
+    scene_ID = str(row[0])
+    # Fixing letter (X:Folder -> X:\Folder)
+    current_filename = str(row[1])
+    current_directory = str(row[2])
+    current_path = os.path.join(current_directory, current_filename)
+    file_extension = os.path.splitext(current_filename)[1]
+    scene_title = str(row[3])
+    scene_date = str(row[4])
+    scene_Studio_id = str(row[5])
+    file_height = str(row[6])
+    # By default, title contains extensions.
+    scene_title = re.sub(file_extension + "$", "", scene_title)
+
+    performer_name = get_Perf_fromSceneID(scene_ID)
+
+    studio_name = ""
+    if scene_Studio_id and scene_Studio_id != "None":
+        studio_name = get_Studio_fromID(scene_Studio_id)
+
+    if file_height == "4320":
+        file_height = "8k"
+    else:
+        if file_height == "2160":
+            file_height = "4k"
+        else:
+            file_height = "{}p".format(file_height)
+
+    scene_info = {
+        "title": scene_title,
+        "date": scene_date,
+        "performer": performer_name,
+        "studio": studio_name,
+        "height": file_height,
+    }
+    logPrint("[DEBUG] Scene information: {}".format(scene_info))
+    # Create the new filename
+    new_filename = makeFilename(scene_info, query_filename) + file_extension
+    if "None" in new_filename:
+        logPrint(
+            "[Error] Information missing for new filename, ID: {}".format(scene_ID)
+        )
+        return None
+
+    # Remove illegal character for Windows ('#' and ',' is not illegal you can remove it)
+    new_filename = re.sub('[\\/:"*?<>|#,]+', "", new_filename)
+
+    # Replace the old filename by the new in the filepath
+    new_path = current_path.replace(current_filename, new_filename)
+
+    if len(new_path) > 240:
+        logPrint("[Warn] The Path is too long ({})".format(new_path))
+        # We only use the date and title to get a shorter file (eg: 2017-04-27 - Oni Chichi.mp4)
+        if scene_info.get("date"):
+            reducePath = (
+                len(
+                    current_directory
+                    + scene_info["title"]
+                    + scene_info["date"]
+                    + file_extension
+                )
+                + 3
+            )
+        else:
+            reducePath = (
+                len(current_directory + scene_info["title"] + file_extension) + 3
+            )
+        if reducePath < 240:
+            if scene_info.get("date"):
+                new_filename = (
+                    makeFilename(scene_info, "$date - $title") + file_extension
+                )
+            else:
+                new_filename = makeFilename(scene_info, "$title") + file_extension
+            # new_path = re.sub('{}$'.format(current_filename), new_filename, current_path)
+            new_path = current_path.replace(current_filename, new_filename)
+            logPrint("Reduced filename to: {}".format(new_filename))
+        else:
+            logPrint("[Error] Can't manage to reduce the path, ID: {}".format(scene_ID))
+            return None
+    return scene_ID, current_filename, new_filename, current_path, new_path
+
+
+def rename_File(scene_ID, current_filename, current_path, new_path):
+    #
+    # THIS PART WILL EDIT YOUR DATABASE, FILES (be careful and know what you do)
+    #
+    # Windows Rename
+    if DRY_RUN == False:
+        if os.path.isfile(current_path) == True:
+            os.rename(current_path, new_path)
+            if os.path.isfile(new_path) == True:
+                logPrint("[OS] File Renamed! ({})".format(current_filename))
+                if USING_LOG == True:
+                    print(
+                        "{}|{}|{}\n".format(scene_ID, current_path, new_path),
+                        file=open("rename_log.txt", "a", encoding="utf-8"),
+                    )
+                return True
+            else:
+                logPrint("[OS] File failed to rename ? ({})".format(current_filename))
+                print(
+                    "{} -> {}\n".format(current_path, new_path),
+                    file=open("renamer_fail.txt", "a", encoding="utf-8"),
+                )
+        else:
+            logPrint(
+                "[OS] File don't exist in your Disk/Drive ({})".format(current_path)
+            )
+    else:
+        logPrint("[DRY_RUN][OS] File should be renamed")
+        print(
+            "{} -> {}\n".format(current_path, new_path),
+            file=open("renamer_dryrun.txt", "a", encoding="utf-8"),
+        )
+    return False
+
+
+def log_Duplicate(dupl_ids, new_filename):
+    for dupl_id in dupl_ids:
+        logPrint("[Error] Same filename: [{}]".format(dupl_id))
+        print(
+            "[{}] - {}\n".format(dupl_id, new_filename),
+            file=open("renamer_duplicate.txt", "a", encoding="utf-8"),
+        )
+    logPrint("\n")
+
+
 def edit_db(query_filename, optional_query=""):
     scene_query = """
-    SELECT s.id,f.basename,d.path,s.title,s.date,s.studio_id,vf.height
+    SELECT s.id,f.basename,d.path,s.title,s.date,s.studio_id,vf.height,f.id
     FROM scenes AS s
     LEFT JOIN scenes_files AS sf ON s.id = sf.scene_id
     LEFT JOIN files AS f ON sf.file_id = f.id
@@ -150,90 +301,19 @@ def edit_db(query_filename, optional_query=""):
         logPrint("[Warn] There is no scene to change with this query")
         return
     logPrint("Scenes numbers: {}".format(len(record)))
+    load_Names()
+    if BULK_MODE == True:
+        edit_db_bulk(record, query_filename)
+        return
     progressbar_Index = 0
     progress = progressbar.ProgressBar(redirect_stdout=True).start(len(record))
     for row in record:
         progress.update(progressbar_Index + 1)
         progressbar_Index += 1
-        scene_ID = str(row[0])
-        # Fixing letter (X:Folder -> X:\Folder)
-        current_filename = str(row[1])
-        current_directory = str(row[2])
-        current_path = os.path.join(current_directory, current_filename)
-        file_extension = os.path.splitext(current_filename)[1]
-        scene_title = str(row[3])
-        scene_date = str(row[4])
-        scene_Studio_id = str(row[5])
-        file_height = str(row[6])
-        # By default, title contains extensions.
-        scene_title = re.sub(file_extension + "$", "", scene_title)
-
-        performer_name = get_Perf_fromSceneID(scene_ID)
-
-        studio_name = ""
-        if scene_Studio_id and scene_Studio_id != "None":
-            studio_name = get_Studio_fromID(scene_Studio_id)
-
-        if file_height == "4320":
-            file_height = "8k"
-        else:
-            if file_height == "2160":
-                file_height = "4k"
-            else:
-                file_height = "{}p".format(file_height)
-
-        scene_info = {
-            "title": scene_title,
-            "date": scene_date,
-            "performer": performer_name,
-            "studio": studio_name,
-            "height": file_height,
-        }
-        logPrint("[DEBUG] Scene information: {}".format(scene_info))
-        # Create the new filename
-        new_filename = makeFilename(scene_info, query_filename) + file_extension
-        if "None" in new_filename:
-            logPrint("[Error] Information missing for new filename, ID: {}".format(scene_ID))
+        new_file = get_NewFilename(row, query_filename)
+        if new_file is None:
             continue
-
-        # Remove illegal character for Windows ('#' and ',' is not illegal you can remove it)
-        new_filename = re.sub('[\\/:"*?<>|#,]+', "", new_filename)
-
-        # Replace the old filename by the new in the filepath
-        new_path = current_path.replace(current_filename, new_filename)
-
-        if len(new_path) > 240:
-            logPrint("[Warn] The Path is too long ({})".format(new_path))
-            # We only use the date and title to get a shorter file (eg: 2017-04-27 - Oni Chichi.mp4)
-            if scene_info.get("date"):
-                reducePath = (
-                    len(
-                        current_directory
-                        + scene_info["title"]
-                        + scene_info["date"]
-                        + file_extension
-                    )
-                    + 3
-                )
-            else:
-                reducePath = (
-                    len(current_directory + scene_info["title"] + file_extension) + 3
-                )
-            if reducePath < 240:
-                if scene_info.get("date"):
-                    new_filename = (
-                        makeFilename(scene_info, "$date - $title") + file_extension
-                    )
-                else:
-                    new_filename = makeFilename(scene_info, "$title") + file_extension
-                # new_path = re.sub('{}$'.format(current_filename), new_filename, current_path)
-                new_path = current_path.replace(current_filename, new_filename)
-                logPrint("Reduced filename to: {}", new_filename)
-            else:
-                logPrint(
-                    "[Error] Can't manage to reduce the path, ID: {}".format(scene_ID)
-                )
-                continue
+        scene_ID, current_filename, new_filename, current_path, new_path = new_file
 
         # Looking for duplicate filename
         cursor.execute(
@@ -242,13 +322,7 @@ def edit_db(query_filename, optional_query=""):
         )
         dupl_check = cursor.fetchall()
         if len(dupl_check) > 0:
-            for dupl_row in dupl_check:
-                logPrint("[Error] Same filename: [{}]".format(dupl_row[0]))
-                logPrint(
-                    "[{}] - {}\n".format(dupl_row[0], new_filename),
-                    file=open("renamer_duplicate.txt", "a", encoding="utf-8"),
-                )
-            logPrint("\n")
+            log_Duplicate([dupl_row[0] for dupl_row in dupl_check], new_filename)
             continue
 
         logPrint("[DEBUG] Filename: {} -> {}".format(current_filename, new_filename))
@@ -257,38 +331,7 @@ def edit_db(query_filename, optional_query=""):
             logPrint("[DEBUG] File already good.\n")
             continue
         else:
-            #
-            # THIS PART WILL EDIT YOUR DATABASE, FILES (be careful and know what you do)
-            #
-            # Windows Rename
-            if DRY_RUN == False:
-                if os.path.isfile(current_path) == True:
-                    os.rename(current_path, new_path)
-                    if os.path.isfile(new_path) == True:
-                        logPrint("[OS] File Renamed! ({})".format(current_filename))
-                        if USING_LOG == True:
-                            print(
-                                "{}|{}|{}\n".format(scene_ID, current_path, new_path),
-                                file=open("rename_log.txt", "a", encoding="utf-8"),
-                            )
-                    else:
-                        logPrint(
-                            "[OS] File failed to rename ? ({})".format(current_filename)
-                        )
-                        print(
-                            "{} -> {}\n".format(current_path, new_path),
-                            file=open("renamer_fail.txt", "a", encoding="utf-8"),
-                        )
-                else:
-                    logPrint(
-                        "[OS] File don't exist in your Disk/Drive ({})".format(current_path)
-                    )
-            else:
-                logPrint("[DRY_RUN][OS] File should be renamed")
-                print(
-                    "{} -> {}\n".format(current_path, new_path),
-                    file=open("renamer_dryrun.txt", "a", encoding="utf-8"),
-                )
+            rename_File(scene_ID, current_filename, current_path, new_path)
             logPrint("\n")
         # break
     progress.finish()
@@ -297,6 +340,81 @@ def edit_db(query_filename, optional_query=""):
     return
 
 
+def edit_db_bulk(record, query_filename):
+    # All the filenames in the database (lowercase, like the LIKE check) -> scene ids
+    basenames = {}
+    cursor.execute(
+        "SELECT sf.scene_id,f.basename FROM scenes_files AS sf LEFT JOIN files AS f ON sf.file_id = f.id;"
+    )
+    for row in cursor.fetchall():
+        basenames.setdefault(str(row[1]).lower(), set()).add(str(row[0]))
+    logPrint("[DEBUG] {} filenames loaded".format(len(basenames)))
+
+    # Compute every new filename first
+    rename_list = []
+    for row in record:
+        new_file = get_NewFilename(row, query_filename)
+        if new_file is None:
+            continue
+        scene_ID, current_filename, new_filename, current_path, new_path = new_file
+        logPrint("[DEBUG] Filename: {} -> {}".format(current_filename, new_filename))
+        if new_path == current_path:
+            logPrint("[DEBUG] File already good.\n")
+            continue
+        # Looking for duplicate filename (in the database or given to a previous scene)
+        dupl_ids = basenames.get(new_filename.lower(), set()) - {scene_ID}
+        if len(dupl_ids) > 0:
+            log_Duplicate(sorted(dupl_ids, key=int), new_filename)
+            continue
+        basenames.setdefault(new_filename.lower(), set()).add(scene_ID)
+        rename_list.append((row[7], new_file))
+    logPrint("Files to rename: {}".format(len(rename_list)))
+    if len(rename_list) == 0:
+        return
+
+    # Rename & update the database by chunk, 1 transaction per chunk
+    progress = progressbar.ProgressBar(redirect_stdout=True).start(len(rename_list))
+    for chunk_start in range(0, len(rename_list), CHUNK_SIZE):
+        chunk = rename_list[chunk_start : chunk_start + CHUNK_SIZE]
+        db_update = []
+        try:
+            for file_ID, new_file in chunk:
+                scene_ID, current_filename, new_filename, current_path, new_path = (
+                    new_file
+                )
+                logPrint("[DEBUG] Path: {} -> {}".format(current_path, new_path))
+                try:
+                    renamed = rename_File(
+                        scene_ID, current_filename, current_path, new_path
+                    )
+                except OSError as err:
+                    logPrint(
+                        "[OS] File failed to rename ({}) {}".format(
+                            current_filename, err
+                        )
+                    )
+                    print(
+                        "{} -> {}\n".format(current_path, new_path),
+                        file=open("renamer_fail.txt", "a", encoding="utf-8"),
+                    )
+                    continue
+                if renamed:
+                    db_update.append((new_filename, file_ID))
+        finally:
+            # the files already renamed are saved even if the chunk is interrupted
+            if DRY_RUN == False and len(db_update) > 0:
+                cursor.executemany("UPDATE files SET basename=? WHERE id=?;", db_update)
+                sqliteConnection.commit()
+        progress.update(chunk_start + len(chunk))
+        logPrint(
+            "[DB] {}/{} files done ({} updated in this chunk)".format(
+                chunk_start + len(chunk), len(rename_list), len(db_update)
+            )
+        )
+    progress.finish()
+    return
+
+
 try:
     sqliteConnection = sqlite3.connect(DB_PATH)
     cursor = sqliteConnection.cursor()